@@ -1,21 +1,46 @@
 import os
+import io
+import cProfile
+import pstats
+import csv
 import json
+import logging
 import asyncio
+import heapq
 import random
-from time import monotonic
+import re
+import signal
+import sqlite3
+import tempfile
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from functools import cache
+from time import monotonic, perf_counter, time
 from pathlib import Path
 
+from aiohttp import web
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, F, Router, BaseMiddleware
-from aiogram.filters import StateFilter
+from aiogram.filters import Filter, StateFilter
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import (
     Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton,
 )
-from aiogram.types import FSInputFile
+from aiogram.types import BufferedInputFile, FSInputFile
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.enums import ChatMemberStatus
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # ===================== ENV =====================
 env_path = Path(__file__).resolve().parent / ".env"
@@ -27,13 +52,456 @@ INFO_ADMIN_ID = 7420305714  # @xolboyevv77 - ro'yxatdan o'tganlar
 CARD_NUMBER = os.getenv("CARD_NUMBER", "9860080347733265")
 CHANNEL = "@bilimulash_kanal"
 USERS_FILE = Path(__file__).resolve().parent / "users.json"
+USERS_JOURNAL = Path(__file__).resolve().parent / "users.journal"
+DB_FILE = Path(os.getenv("DB_FILE", Path(__file__).resolve().parent / "bot.sqlite3"))
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # masalan https://bot.example.com — bo'sh bo'lsa polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # webhook rejimida majburiy: barcha nusxalarda bir xil
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0").lower() in ("1", "true", "yes")
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable is missing.")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    # Har jarayonda tasodifiy secret bo'lsa, ikkinchi nusxa yoki qayta ishga tushish webhookni boshqa
+    # secret bilan qayta o'rnatadi va birinchisi Telegram so'rovlarini rad eta boshlaydi.
+    raise ValueError("WEBHOOK_SECRET environment variable is required when WEBHOOK_URL is set.")
+
+log = logging.getLogger("bot")
+
+# ===================== METRICS =====================
+# METRICS_PORT berilsa http://METRICS_HOST:METRICS_PORT/metrics da Prometheus matn formatidagi
+# ko'rsatkichlar. Qo'shimcha kutubxonasiz: hisoblagich, gistogramma va o'qilganda hisoblanadigan qiymatlar.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — o'chirilgan
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _metric_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [
+        f'{n}="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for n, v in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def lines(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{_metric_labels(self.labels, labels)} {value}"
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self.series: dict[tuple, list] = {}  # labels -> [har bucket soni..., +Inf soni, yig'indi]
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *labels)
+
+    def lines(self):
+        for labels, series in self.series.items():
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_metric_labels(self.labels, labels, le)} {total}"
+            yield f"{self.name}_sum{_metric_labels(self.labels, labels)} {series[-1]}"
+            yield f"{self.name}_count{_metric_labels(self.labels, labels)} {total}"
+
+class Sampled:
+    """Qiymati /metrics o'qilganda fn() dan olinadi: son yoki {label qiymatlari: son}."""
+
+    def __init__(self, name: str, doc: str, fn, labels: tuple = (), kind: str = "gauge"):
+        self.name, self.doc, self.fn, self.labels, self.kind = name, doc, fn, labels, kind
+
+    def lines(self):
+        try:
+            values = self.fn()
+        except Exception:
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            labels = labels if isinstance(labels, tuple) else (labels,)
+            yield f"{self.name}{_metric_labels(self.labels, labels)} {float(value)}"
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: list = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def sampled(self, name: str, doc: str, labels: tuple = (), kind: str = "gauge"):
+        def register(fn):
+            self.register(Sampled(name, doc, fn, labels, kind))
+            return fn
+        return register
+
+    def render(self) -> str:
+        out = []
+        for m in self.metrics:
+            out.append(f"# HELP {m.name} {m.doc}")
+            out.append(f"# TYPE {m.name} {m.kind}")
+            out.extend(m.lines())
+        return "\n".join(out) + "\n"
+
+metrics = MetricsRegistry()
+handler_seconds = metrics.register(Histogram("bot_handler_seconds", "Handler bajarilish vaqti", ("handler", "state")))
+updates_total = metrics.register(Counter("bot_updates_total", "Kelgan update'lar turi bo'yicha", ("type",)))
+api_seconds = metrics.register(Histogram("bot_api_request_seconds", "Bot API so'rovi vaqti", ("method",)))
+api_errors_total = metrics.register(Counter("bot_api_errors_total", "Bot API xatolari", ("method", "error")))
+storage_seconds = metrics.register(Histogram("bot_storage_seconds", "users.json o'qish/yozish vaqti", ("op",)))
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        updates_total.inc(getattr(event, "event_type", type(event).__name__))
+        return await handler(event, data)
+
+def handler_name(data: dict) -> str:
+    """Ichki middleware'dagi data bo'yicha handler nomi (menyu marshrutida — asl handler)."""
+    route = data.get("menu_route")
+    if route is not None:
+        return route.handler.__name__
+    return getattr(getattr(data.get("handler"), "callback", None), "__name__", "unknown")
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        start = perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_seconds.observe(perf_counter() - start, handler_name(data), data.get("raw_state") or "none")
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        start = perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            api_errors_total.inc(name, type(e).__name__)
+            raise
+        finally:
+            api_seconds.observe(perf_counter() - start, name)
+
+# ===================== SEKIN UPDATE'LAR =====================
+# Har bir update vaqti o'lchanadi; SLOW_UPDATE_MS dan oshganlari handler, holat va storage/API vaqti
+# bilan logga yoziladi va oxirgi SLOW_WINDOW soniyadagi eng sekin SLOW_TOP_N tasi /slow da ko'rinadi.
+# Storage (run_storage) va API (bot so'rovi, navbatda kutish bilan) vaqti _update_timing orqali yig'iladi.
+# Handler ichida boshlangan fon vazifalari (flush, tarqatish, profil) avval _update_timing.set(None)
+# qiladi — aks holda ular allaqachon yozilgan update hisobiga vaqt qo'shib boradi.
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "1000"))
+SLOW_TOP_N = 10
+SLOW_WINDOW = 3600.0
+PROFILE_MAX_SECONDS = 300
+
+@dataclass(slots=True)
+class UpdateTiming:
+    handler: str = "-"
+    state: str = "none"
+    storage: float = 0.0
+    api: float = 0.0
+
+_update_timing: ContextVar[UpdateTiming | None] = ContextVar("update_timing", default=None)
+
+class SlowUpdateLog:
+    def __init__(self, threshold_ms: float = SLOW_UPDATE_MS, window: float = SLOW_WINDOW, max_records: int = 1000):
+        self.threshold = threshold_ms / 1000
+        self.window = window
+        self.records: deque[tuple[float, float, UpdateTiming]] = deque(maxlen=max_records)  # (vaqt, davomiylik, timing)
+
+    def record(self, elapsed: float, timing: UpdateTiming):
+        if elapsed < self.threshold:
+            return
+        timing = replace(timing)  # nusxa: keyin qo'shilgan vaqt yozuvni o'zgartirmasin
+        self.records.append((time(), elapsed, timing))
+        log.warning(
+            "Sekin update: %.0f ms | %s | %s | storage %.0f ms | api %.0f ms",
+            elapsed * 1000, timing.handler, timing.state, timing.storage * 1000, timing.api * 1000,
+        )
+
+    def top(self, n: int = SLOW_TOP_N) -> list[tuple[float, float, UpdateTiming]]:
+        since = time() - self.window
+        return heapq.nlargest(n, (r for r in self.records if r[0] >= since), key=lambda r: r[1])
+
+slow_updates = SlowUpdateLog()
+
+class SlowUpdateMiddleware(BaseMiddleware):
+    """dp.update outer middleware: butun update (middleware, filtr va handler) vaqti."""
+    async def __call__(self, handler, event, data):
+        timing = UpdateTiming()
+        token = _update_timing.set(timing)
+        start = perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            _update_timing.reset(token)
+            slow_updates.record(perf_counter() - start, timing)
+
+class UpdateLabelMiddleware(BaseMiddleware):
+    """Ichki middleware: tanlangan handler nomi va FSM holatini UpdateTiming ga yozadi."""
+    async def __call__(self, handler, event, data):
+        timing = _update_timing.get()
+        if timing is not None:
+            timing.handler = handler_name(data)
+            timing.state = data.get("raw_state") or "none"
+        return await handler(event, data)
+
+class ApiTimingMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        timing = _update_timing.get()
+        if timing is None:
+            return await make_request(bot, method)
+        start = perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            timing.api += perf_counter() - start
+
+# ===================== FSM STORAGE =====================
+# FSM_STORAGE=sqlite (standart) — holatlar xotirada turadi, o'zgarganlari har FSM_FLUSH_INTERVAL
+# soniyada DB_FILE ga yoziladi (write-behind). Qayta ishga tushganda yarim qolgan
+# SlideState/VideoState/RegState suhbatlari va ularning ma'lumotlari tiklanadi.
+# FSM_STORAGE=memory — aiogram'ning oddiy MemoryStorage'i.
+# Tashlab ketilgan suhbatlar FSM_STATE_TTLS bo'yicha (avval to'liq holat nomi, keyin StatesGroup,
+# so'ng FSM_TTL_DEFAULT) muddati o'tgach fonda o'chiriladi. FSM_TTLS='{"RegState": 600}' bilan o'zgartiriladi.
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").lower()
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1.0"))
+FSM_READ_PERSIST_INTERVAL = 60.0  # faqat o'qilgan kontekstning faollik vaqti shundan tez-tez yozilmaydi
+FSM_TTL_DEFAULT = float(os.getenv("FSM_TTL_DEFAULT", str(6 * 3600)))
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", "60"))
+FSM_SWEEP_BATCH = int(os.getenv("FSM_SWEEP_BATCH", "500"))
+FSM_STATE_TTLS: dict[str, float] = {
+    "SubState": 30 * 60,
+    "RegState": 30 * 60,
+    "BilimUlashUserState": 30 * 60,
+    "SlideState": 3 * 3600,
+    "VideoState": 3 * 3600,
+    "SlideState:payment": 48 * 3600,
+    "VideoState:img_to_video_payment": 48 * 3600,
+    "VideoState:image_gen_payment": 48 * 3600,
+    "VideoState:custom_payment": 48 * 3600,
+    **json.loads(os.getenv("FSM_TTLS", "{}")),
+}
+
+def open_sqlite(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def fsm_key(key: StorageKey) -> str:
+    return ":".join(str(part) for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id or "",
+        getattr(key, "business_connection_id", None) or "", key.destiny,
+    ))
+
+class PersistentFSMStorage(BaseStorage):
+    def __init__(self, path: Path, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 ttls: dict[str, float] = FSM_STATE_TTLS, default_ttl: float = FSM_TTL_DEFAULT):
+        self.conn = open_sqlite(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self.lock = threading.Lock()
+        self.flush_interval = flush_interval
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.min_ttl = min([default_ttl, *ttls.values()])
+        self.states: dict[str, str | None] = {}
+        self.data: dict[str, dict] = {}
+        self.touched: OrderedDict[str, float] = OrderedDict()  # eng eski faollik birinchi
+        self.saved: dict[str, float] = {}  # DB dagi updated qiymati
+        self.dirty: set[str] = set()
+        self.evicted = 0
+        self._flush_task: asyncio.Task | None = None
+        self._closed = False
+        for k, state, data, updated in self.conn.execute("SELECT key, state, data, updated FROM fsm ORDER BY updated"):
+            self.states[k] = state
+            self.data[k] = json.loads(data)
+            self.touched[k] = self.saved[k] = updated
+
+    def ttl_for(self, state: str | None) -> float:
+        if state is None:
+            return self.default_ttl
+        return self.ttls.get(state) or self.ttls.get(state.split(":", 1)[0]) or self.default_ttl
+
+    def _expired(self, k: str, now: float) -> bool:
+        return now - self.touched.get(k, now) > self.ttl_for(self.states.get(k))
+
+    def _evict(self, k: str):
+        self.states.pop(k, None)
+        self.data.pop(k, None)
+        self.touched.pop(k, None)
+        self.saved.pop(k, None)
+        self.evicted += 1
+        self._schedule(k)
+
+    def _alive(self, k: str) -> bool:
+        """O'qishda: muddati o'tgan bo'lsa o'chiriladi, aks holda faollik vaqti yangilanadi.
+        TTL oxirgi o'qishdan hisoblanadi; DB dagi vaqt har FSM_READ_PERSIST_INTERVAL da bir yangilanadi —
+        qayta ishga tushgach faqat o'qilgan suhbatlar ham muddatidan oldin o'chmaydi."""
+        if k not in self.touched:
+            return False
+        now = time()
+        if self._expired(k, now):
+            self._evict(k)
+            return False
+        self.touched[k] = now
+        self.touched.move_to_end(k)
+        if now - self.saved.get(k, 0.0) > FSM_READ_PERSIST_INTERVAL:
+            self._schedule(k)
+        return True
 
+    def _touch(self, k: str):
+        if self.states.get(k) is None and not self.data.get(k):
+            self.states.pop(k, None)
+            self.data.pop(k, None)
+            self.touched.pop(k, None)
+        else:
+            self.touched[k] = time()
+            self.touched.move_to_end(k)
+        self._schedule(k)
+
+    def _schedule(self, k: str):
+        self.dirty.add(k)
+        if self._flush_task is None and not self._closed:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        _update_timing.set(None)
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        keys, self.dirty = self.dirty, set()
+        if not keys:
+            return
+        now = time()
+        rows = [
+            (k, self.states.get(k), json.dumps(self.data.get(k) or {}, ensure_ascii=False, default=str),
+             self.touched.get(k, now))
+            for k in keys
+        ]
+        for k, *_, updated in rows:
+            if k in self.touched:
+                self.saved[k] = updated
+            else:
+                self.saved.pop(k, None)
+        try:
+            await run_storage(self._write_rows, rows)
+        except Exception:
+            log.exception("FSM flush xatosi")
+            self.dirty.update(keys)
+
+    def _write_rows(self, rows):
+        upserts = [r for r in rows if r[1] is not None or r[2] != "{}"]
+        deletes = [(r[0],) for r in rows if r[1] is None and r[2] == "{}"]
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("INSERT OR REPLACE INTO fsm (key, state, data, updated) VALUES (?, ?, ?, ?)", upserts)
+                self.conn.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = fsm_key(key)
+        self.states[k] = state.state if isinstance(state, State) else state
+        self._touch(k)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        k = fsm_key(key)
+        return self.states.get(k) if self._alive(k) else None
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        k = fsm_key(key)
+        self.data[k] = dict(data)
+        self._touch(k)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        k = fsm_key(key)
+        return dict(self.data.get(k) or {}) if self._alive(k) else {}
+
+    async def sweep(self, batch: int = FSM_SWEEP_BATCH) -> int:
+        """Muddati o'tganlarni eng eskisidan boshlab batch-batch o'chiradi (orada loop'ga yo'l beriladi).
+        min_ttl dan yangiroq kalitlar ko'rilmaydi — ular hali o'cha olmaydi."""
+        now = time()
+        candidates = []
+        for k, touched in self.touched.items():
+            if now - touched <= self.min_ttl:
+                break
+            candidates.append(k)
+        evicted = 0
+        for i in range(0, len(candidates), batch):
+            if i:
+                await asyncio.sleep(0)
+            now = time()
+            for k in candidates[i:i + batch]:
+                if k in self.touched and self._expired(k, now):
+                    self._evict(k)
+                    evicted += 1
+        return evicted
+
+    def stats(self) -> dict:
+        return {"live": len(self.touched), "evicted": self.evicted}
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._flush_task:
+            self._flush_task.cancel()
+        await self.flush()
+
+def create_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE != "sqlite":
+        raise ValueError(f"Unknown FSM_STORAGE: {FSM_STORAGE}")
+    return PersistentFSMStorage(DB_FILE)
+
+async def fsm_sweeper(storage: PersistentFSMStorage, interval: float = FSM_SWEEP_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await storage.sweep()
+        except Exception:
+            log.exception("FSM sweep xatosi")
+
+fsm_storage = create_fsm_storage()
 bot = Bot(BOT_TOKEN)
-dp = Dispatcher()
-priority_router = Router()
+dp = Dispatcher(storage=fsm_storage)
 reg_router = Router()  # ro'yxat orqaga qaytish — birinchi tekshiriladi
 
 async def record_last_user_message(msg: Message, state: FSMContext):
@@ -51,29 +519,368 @@ async def delete_last_user_message(state: FSMContext):
     await state.update_data(last_user_chat_id=None, last_user_msg_id=None)
 
 class ThrottleMiddleware(BaseMiddleware):
-    def __init__(self, min_interval: float = 0.7, warn_interval: float = 2.0):
-        self.min_interval = min_interval
+    """Token-bucket anti-flood: har user va hodisa turi (Message, CallbackQuery) uchun alohida budjet.
+    budgets: {tur: (soniyasiga token, maksimal token)}. Jadval max_users bilan chegaralangan (LRU) —
+    uzoq jim turgan userning bucketi baribir to'lgan bo'ladi, uni o'chirish hech narsani o'zgartirmaydi."""
+
+    def __init__(self, budgets: dict | None = None, warn_interval: float = 2.0, max_users: int = 10000):
+        self.budgets = budgets or {Message: (1 / 0.7, 3), CallbackQuery: (2.0, 5)}
         self.warn_interval = warn_interval
-        self.last_time: dict[int, float] = {}
-        self.last_warn: dict[int, float] = {}
+        self.max_users = max_users
+        self.buckets: OrderedDict[tuple[type, int], list[float]] = OrderedDict()  # [tokens, updated, last_warn]
+        self.dropped = 0
 
     async def __call__(self, handler, event, data):
-        if isinstance(event, Message) and event.from_user:
-            user_id = event.from_user.id
-            if user_id != ADMIN_ID:
-                now = monotonic()
-                last = self.last_time.get(user_id, 0.0)
-                if now - last < self.min_interval:
-                    last_warn = self.last_warn.get(user_id, 0.0)
-                    if now - last_warn > self.warn_interval:
-                        try:
-                            await event.answer("Iltimos, sekinroq yuboring.")
-                        except Exception:
-                            pass
-                        self.last_warn[user_id] = now
-                    return
-                self.last_time[user_id] = now
-        return await handler(event, data)
+        budget = self.budgets.get(type(event))
+        user = getattr(event, "from_user", None)
+        if budget is None or user is None or user.id == ADMIN_ID:
+            return await handler(event, data)
+        rate, capacity = budget
+        key = (type(event), user.id)
+        now = monotonic()
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            bucket = [capacity, now, 0.0]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        self.buckets[key] = bucket
+        if len(self.buckets) > self.max_users:
+            self.buckets.popitem(last=False)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return await handler(event, data)
+        self.dropped += 1
+        warn = now - bucket[2] > self.warn_interval
+        if warn:
+            bucket[2] = now
+        try:
+            if isinstance(event, CallbackQuery):
+                # Tashlangan tugma bosilishiga ham javob beriladi — aks holda tugmadagi soat osilib qoladi
+                await event.answer("Iltimos, sekinroq bosing." if warn else None)
+            elif warn:
+                await event.answer("Iltimos, sekinroq yuboring.")
+        except Exception:
+            pass
+
+# ===================== SEND QUEUE =====================
+# Chatga yuboriladigan barcha Bot API so'rovlari (send*/copy*/forward*/edit*) shu navbatdan o'tadi:
+# umumiy (30/s) va har chat uchun token-bucket, ustuvorlik bo'yicha navbat (user javoblari adminga
+# xabarlardan oldin), TelegramRetryAfter'da o'sha chat to'xtatilib, so'rov keyinroq qayta yuboriladi.
+PRIORITY_USER, PRIORITY_ADMIN, PRIORITY_BULK = 0, 1, 2
+_send_priority: ContextVar[int] = ContextVar("send_priority", default=PRIORITY_USER)
+
+@contextmanager
+def send_priority(level: int):
+    token = _send_priority.set(level)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+class RateBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class SendScheduler(BaseRequestMiddleware):
+    RATE_LIMITED = ("send", "copy", "forward", "edit")
+
+    def __init__(self, global_rate: float = 30, private_rate: float = 1, private_burst: float = 3,
+                 group_rate: float = 20 / 60, workers: int = 8, max_retries: int = 3, max_chats: int = 10000):
+        self.global_bucket = RateBucket(global_rate, global_rate)
+        self.private_rate, self.private_burst, self.group_rate = private_rate, private_burst, group_rate
+        self.chat_buckets: OrderedDict[int | str, RateBucket] = OrderedDict()
+        self.max_chats = max_chats
+        self.workers = workers
+        self.max_retries = max_retries
+        self.queue: asyncio.PriorityQueue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._seq = 0
+        self.depth = {PRIORITY_USER: 0, PRIORITY_ADMIN: 0, PRIORITY_BULK: 0}
+        self.delayed = 0
+        self.counters = {"sent": 0, "failed": 0, "retry_after": 0}
+
+    def _chat_bucket(self, chat_id) -> RateBucket:
+        bucket = self.chat_buckets.pop(chat_id, None)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = RateBucket(self.group_rate, 1) if is_group else RateBucket(self.private_rate, self.private_burst)
+        self.chat_buckets[chat_id] = bucket
+        if len(self.chat_buckets) > self.max_chats:
+            self.chat_buckets.popitem(last=False)
+        return bucket
+
+    def _put(self, prio: int, seq: int, job: list, delay: float = 0.0):
+        # seq qayta navbatga qo'yishda saqlanadi — bir chat ichida tartib buzilmaydi
+        if delay > 0:
+            self.delayed += 1
+            asyncio.get_running_loop().call_later(delay, self._put_delayed, prio, seq, job)
+            return
+        self.depth[prio] += 1
+        self.queue.put_nowait((prio, seq, job))
+
+    def _put_delayed(self, prio: int, seq: int, job: list):
+        self.delayed -= 1
+        self._put(prio, seq, job)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        api_method = getattr(method, "__api_method__", "")
+        if chat_id is None or not api_method.startswith(self.RATE_LIMITED):
+            return await make_request(bot, method)
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        self._put(_send_priority.get(), self._seq, [chat_id, make_request, bot, method, fut, 0])
+        return await fut
+
+    async def _worker(self):
+        while True:
+            prio, seq, job = await self.queue.get()
+            self.depth[prio] -= 1
+            chat_id, make_request, bot, method, fut, attempt = job
+            if fut.done():
+                continue  # chaqiruvchi bekor qilgan
+            now = monotonic()
+            chat_bucket = self._chat_bucket(chat_id)
+            wait = max(self.global_bucket.wait_time(now), chat_bucket.wait_time(now))
+            if wait > 0:
+                self._put(prio, seq, job, wait)
+                continue
+            self.global_bucket.tokens -= 1
+            chat_bucket.tokens -= 1
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.counters["retry_after"] += 1
+                if attempt >= self.max_retries:
+                    self.counters["failed"] += 1
+                    if not fut.done():
+                        fut.set_exception(e)
+                    continue
+                chat_bucket.blocked_until = monotonic() + e.retry_after
+                job[5] = attempt + 1
+                self._put(prio, seq, job, e.retry_after)
+            except Exception as e:
+                self.counters["failed"] += 1
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                self.counters["sent"] += 1
+                if not fut.done():
+                    fut.set_result(result)
+
+    def stats(self) -> dict:
+        return {**self.counters, "queued": dict(self.depth), "delayed": self.delayed}
+
+send_queue = SendScheduler()
+bot.session.middleware(ApiTimingMiddleware())  # navbatdan oldin — handler kutgan butun vaqt
+bot.session.middleware(send_queue)
+if METRICS_PORT:
+    bot.session.middleware(ApiMetricsMiddleware())  # navbatdan keyin — faqat HTTP so'rov vaqti
+
+# ===================== BACKGROUND JOBS =====================
+# Adminga xabarlar kabi qo'shimcha ishlar avval DB_FILE dagi jobs jadvaliga yoziladi, keyin
+# JOB_WORKERS ta worker bajaradi. Xato bo'lsa eksponensial kutish bilan qayta urinadi;
+# qayta ishga tushganda tugallanmagan ishlar davom ettiriladi. Handler faqat userga javobni kutadi.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "8"))
+JOB_BACKOFF_BASE = 2.0
+JOB_BACKOFF_MAX = 600.0
+JOB_POLL_INTERVAL = 30.0
+
+class JobQueue:
+    def __init__(self, path: Path, workers: int = JOB_WORKERS, max_attempts: int = JOB_MAX_ATTEMPTS,
+                 max_queued: int = 1000):
+        self.conn = open_sqlite(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_run REAL NOT NULL, last_error TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_due_idx ON jobs(status, next_run)")
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.max_queued = max_queued
+        self.handlers: dict[str, object] = {}
+        self.queue: asyncio.Queue | None = None
+        self._scheduled: set[int] = set()  # navbatda yoki taymerda turgan job id'lari
+        self._tasks: list[asyncio.Task] = []
+        self.counters = {"done": 0, "retried": 0, "dead": 0}
+
+    def handler(self, kind: str):
+        """Handler keyingi joblarni [(kind, payload)] ko'rinishida qaytarishi mumkin (_complete ga qarang)."""
+        def register(fn):
+            self.handlers[kind] = fn
+            return fn
+        return register
+
+    def _execute(self, sql: str, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params)
+
+    def _insert(self, kind: str, payload: str) -> int:
+        return self._execute(
+            "INSERT INTO jobs (kind, payload, next_run) VALUES (?, ?, ?)", (kind, payload, time())
+        ).lastrowid
+
+    def _due(self, until: float) -> list:
+        return self._execute(
+            "SELECT id, kind, payload, attempts, next_run FROM jobs"
+            " WHERE status = 'pending' AND next_run <= ? ORDER BY next_run LIMIT ?",
+            (until, self.max_queued),
+        ).fetchall()
+
+    async def enqueue(self, kind: str, **payload) -> int:
+        job_id = await run_storage(self._insert, kind, json.dumps(payload, ensure_ascii=False))
+        if self.queue is not None:
+            self._schedule((job_id, kind, payload, 0))
+        return job_id
+
+    async def enqueue_many(self, kind: str, payloads: list[dict]) -> list[int]:
+        """Bir nechta job — bitta tranzaksiyada."""
+        follow_ups = [(kind, payload) for payload in payloads]
+        ids = await run_storage(self._complete, None, follow_ups)
+        if self.queue is not None:
+            for job_id, payload in zip(ids, payloads):
+                self._schedule((job_id, kind, payload, 0))
+        return ids
+
+    def _schedule(self, item: tuple, delay: float = 0.0):
+        self._scheduled.add(item[0])
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._push, item)
+        else:
+            self._push(item)
+
+    def _push(self, item: tuple):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self._scheduled.discard(item[0])  # poller keyinroq DB dan oladi
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queued)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._poll()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+    async def _poll(self):
+        while True:
+            now = time()
+            for job_id, kind, payload, attempts, next_run in await run_storage(self._due, now + JOB_POLL_INTERVAL):
+                if job_id not in self._scheduled:
+                    self._schedule((job_id, kind, json.loads(payload), attempts), next_run - now)
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            job_id, kind, payload, _ = item
+            try:
+                with send_priority(PRIORITY_ADMIN):
+                    follow_ups = await self.handlers[kind](**payload) or []
+            except (KeyError, TypeError, TelegramBadRequest, TelegramForbiddenError) as e:
+                await self._fail(item, e, permanent=True)
+            except Exception as e:
+                await self._fail(item, e)
+            else:
+                self.counters["done"] += 1
+                try:
+                    new_ids = await run_storage(self._complete, job_id, follow_ups)
+                finally:
+                    self._scheduled.discard(job_id)  # yozuv o'chgandan keyin — aks holda poller qayta oladi
+                for new_id, (new_kind, new_payload) in zip(new_ids, follow_ups):
+                    self._schedule((new_id, new_kind, new_payload, 0))
+
+    def _complete(self, job_id: int | None, follow_ups: list[tuple[str, dict]]) -> list[int]:
+        """Job o'chiriladi va handler qaytargan keyingi joblar qo'shiladi — bitta tranzaksiyada,
+        shuning uchun keyingi job yozilmay qolib, birinchisi qayta bajarilmaydi."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if job_id is not None:
+                    self.conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                ids = [
+                    self.conn.execute(
+                        "INSERT INTO jobs (kind, payload, next_run) VALUES (?, ?, ?)",
+                        (kind, json.dumps(payload, ensure_ascii=False), time()),
+                    ).lastrowid
+                    for kind, payload in follow_ups
+                ]
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return ids
+
+    async def _fail(self, item: tuple, error: Exception, permanent: bool = False):
+        job_id, kind, payload, attempts = item
+        attempts += 1
+        if permanent or attempts >= self.max_attempts:
+            self.counters["dead"] += 1
+            log.error("Job #%s (%s) bajarilmadi", job_id, kind, exc_info=error)
+            try:
+                await run_storage(
+                    self._execute, "UPDATE jobs SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                    (attempts, repr(error), job_id),
+                )
+            finally:
+                self._scheduled.discard(job_id)
+            return
+        self.counters["retried"] += 1
+        delay = min(JOB_BACKOFF_MAX, JOB_BACKOFF_BASE * 2 ** (attempts - 1))
+        log.warning("Job #%s (%s) %s-urinish xato: %r — %.0f s dan keyin qayta", job_id, kind, attempts, error, delay)
+        await run_storage(
+            self._execute, "UPDATE jobs SET attempts = ?, next_run = ?, last_error = ? WHERE id = ?",
+            (attempts, time() + delay, repr(error), job_id),
+        )
+        self._schedule((job_id, kind, payload, attempts), delay)
+
+    def stats(self) -> dict:
+        return {**self.counters, "queued": self.queue.qsize() if self.queue else 0, "scheduled": len(self._scheduled)}
+
+jobs = JobQueue(DB_FILE)
+
+@jobs.handler("bot_send")
+async def job_bot_send(method: str, reply_markup: dict | None = None, then: dict | None = None, **kwargs):
+    if method not in ("send_message", "send_photo", "send_document"):
+        raise KeyError(method)
+    if reply_markup:
+        kwargs["reply_markup"] = InlineKeyboardMarkup.model_validate(reply_markup)
+    await getattr(bot, method)(**kwargs)
+    if then:
+        return [("bot_send", then)]  # navbatdagi xabar faqat shu yetkazilgandan keyin
+
+async def notify_admin(method: str, chat_id: int = ADMIN_ID, reply_markup: InlineKeyboardMarkup | None = None,
+                       then: dict | None = None, **kwargs):
+    """Adminga xabarni fonda yuborish (jobs orqali). then — shundan keyin yuboriladigan xabar
+    (bot_send argumentlari); workerlar parallel bo'lgani uchun tartib shu zanjir bilan saqlanadi."""
+    if reply_markup is not None:
+        kwargs["reply_markup"] = reply_markup.model_dump(exclude_none=True)
+    if then is not None:
+        kwargs["then"] = {"chat_id": chat_id, **then}
+    await jobs.enqueue("bot_send", method=method, chat_id=chat_id, **kwargs)
 
 # ===================== BANNER (BotFatherda description qo'yiladi) =====================
 BANNER = (
@@ -85,74 +892,783 @@ BANNER = (
 )
 
 # ===================== USER STORAGE =====================
+# STORAGE_BACKEND=json   — users.json (standart)
+# STORAGE_BACKEND=journal — users.json snapshot + users.journal (append-only), fonda compaction
+# STORAGE_BACKEND=sqlite — DB_FILE (WAL, indekslar bilan); birinchi ishga tushishda users.json ko'chiriladi
+# users.json keshi: fayl mtime/hajmi o'zgarmaguncha qayta o'qilmaydi, save_users keshni yangilaydi.
+# load_users() qaytargan dict umumiy — o'zgartirilgan bo'lsa, albatta save_users() chaqirilsin.
+_users_lock = threading.RLock()
+_users_cache: dict = {"data": None, "sig": None}
+_users_cache_counters = {"hits": 0, "misses": 0}
+
+def _users_file_sig():
+    try:
+        st = USERS_FILE.stat()
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def users_cache_stats() -> dict:
+    hits, misses = _users_cache_counters["hits"], _users_cache_counters["misses"]
+    total = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+def _ensure_status_index(data):
+    """data["by_status"]: tartib raqami -> user_id. Yo'q yoki eskirgan bo'lsa qayta quriladi."""
+    index = data.get("by_status")
+    if isinstance(index, dict) and len(index) == len(data["users"]):
+        return
+    data["by_status"] = {
+        str(u["status"]): uid for uid, u in data["users"].items() if u.get("status") is not None
+    }
+
 def load_users():
-    if USERS_FILE.exists():
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
+    with _users_lock, storage_seconds.time("load_users"):
+        sig = _users_file_sig()
+        if _users_cache["data"] is not None and _users_cache["sig"] == sig:
+            _users_cache_counters["hits"] += 1
+            return _users_cache["data"]
+        _users_cache_counters["misses"] += 1
+        if sig is not None:
+            with open(USERS_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
             if "bilim" not in data:
                 data["bilim"] = {}
-            return data
-    return {"users": {}, "next_status": 1, "bilim": {}}
+        else:
+            data = {"users": {}, "next_status": 1, "bilim": {}}
+        _ensure_status_index(data)
+        _users_cache["data"], _users_cache["sig"] = data, sig
+        return data
 
-def save_users(data):
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
+def write_users_file(data, path: Path):
+    with open(path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
 
-def get_user_status(user_id: int) -> int | None:
-    data = load_users()
-    uid = str(user_id)
-    if uid in data["users"]:
-        return data["users"][uid].get("status")
-    return None
-
-def register_user(user_id: int, name: str, age: str, region: str, phone: str) -> int:
-    data = load_users()
-    uid = str(user_id)
-    if uid in data["users"]:
-        return data["users"][uid]["status"]  # allaqachon ro'yxatdan o'tgan
-    status = data["next_status"]
-    data["users"][uid] = {"name": name, "age": age, "region": region, "phone": phone, "status": status}
-    data["next_status"] = status + 1
-    save_users(data)
-    return status
-
-def get_user_by_status(status: int) -> int | None:
-    data = load_users()
-    for uid, u in data["users"].items():
-        if u.get("status") == status:
-            return int(uid)
-    return None
-
-def is_registered(user_id: int) -> bool:
-    return get_user_status(user_id) is not None
-
-def add_bilim_number(number: int, message: str):
-    data = load_users()
-    data["bilim"][str(number)] = message
-    save_users(data)
-
-def delete_bilim_number(number: int) -> bool:
-    data = load_users()
-    key = str(number)
-    if key in data["bilim"]:
-        del data["bilim"][key]
-        save_users(data)
+def save_users(data):
+    # Vaqtinchalik faylga yozib, keyin os.replace — yozish o'rtasida qulasa ham users.json buzilmaydi
+    with _users_lock, storage_seconds.time("save_users"):
+        tmp = USERS_FILE.with_name(USERS_FILE.name + ".tmp")
+        try:
+            write_users_file(data, tmp)
+            os.replace(tmp, USERS_FILE)
+        except BaseException:
+            # data (kesh) allaqachon o'zgartirilgan, disk esa eski — keyingi load_users() fayldan o'qisin
+            _users_cache["data"], _users_cache["sig"] = None, None
+            raise
+        _users_cache["data"], _users_cache["sig"] = data, _users_file_sig()
+
+@dataclass(frozen=True, slots=True)
+class BilimEntry:
+    """Bilim Ulash yozuvi: matn va ixtiyoriy keshlangan Telegram fayli (photo/document)."""
+    text: str
+    file_id: str | None = None
+    file_type: str | None = None
+
+def bilim_entry(value) -> BilimEntry:
+    """users.json dagi qiymat: oddiy matn yoki {"text", "file_id", "file_type"}."""
+    if isinstance(value, str):
+        return BilimEntry(value)
+    return BilimEntry(value.get("text", ""), value.get("file_id"), value.get("file_type"))
+
+def apply_user_record(data, rec: dict):
+    """Bitta o'zgarish yozuvini hujjatga qo'llash (journal replay uchun ham). Idempotent."""
+    op = rec["op"]
+    if op == "user":
+        user = rec["user"]
+        data["users"][rec["uid"]] = user
+        data["by_status"][str(user["status"])] = rec["uid"]
+        data["next_status"] = max(data["next_status"], user["status"] + 1)
+    elif op == "bilim_set":
+        if rec.get("file_id"):
+            data["bilim"][rec["number"]] = {"text": rec["message"], "file_id": rec["file_id"], "file_type": rec.get("file_type")}
+        else:
+            data["bilim"][rec["number"]] = rec["message"]
+    elif op == "bilim_del":
+        data["bilim"].pop(rec["number"], None)
+
+class JsonUserStore:
+    """users.json ustidagi ombor (load_users/save_users keshi orqali)."""
+
+    def __init__(self):
+        self._batch_depth = 0
+        self._pending: list[dict] = []
+        self._ids: list[int] = []  # saralangan user_id'lar (user_ids_after uchun), _ids_of hujjatidan
+        self._ids_of: dict | None = None
+
+    @contextmanager
+    def batch(self):
+        """Ichidagi barcha o'zgarishlar bitta _persist() bilan yoziladi."""
+        with _users_lock:
+            self._batch_depth += 1
+            try:
+                yield
+            finally:
+                self._batch_depth -= 1
+                if self._batch_depth == 0 and self._pending:
+                    records, self._pending = self._pending, []
+                    self._persist(records)
+
+    def _load(self):
+        return load_users()
+
+    def _commit(self, rec: dict):
+        apply_user_record(self._load(), rec)
+        self._pending.append(rec)
+        if not self._batch_depth:
+            records, self._pending = self._pending, []
+            self._persist(records)
+
+    def _persist(self, records: list[dict]):
+        save_users(self._load())
+
+    def get_user_status(self, user_id: int) -> int | None:
+        data = self._load()
+        uid = str(user_id)
+        if uid in data["users"]:
+            return data["users"][uid].get("status")
+        return None
+
+    def register_user(self, user_id: int, name: str, age: str, region: str, phone: str) -> int:
+        with _users_lock:
+            data = self._load()
+            uid = str(user_id)
+            if uid in data["users"]:
+                return data["users"][uid]["status"]  # allaqachon ro'yxatdan o'tgan
+            status = data["next_status"]
+            user = {"name": name, "age": age, "region": region, "phone": phone, "status": status}
+            self._commit({"op": "user", "uid": uid, "user": user})
+            if self._ids_of is data:
+                insort(self._ids, user_id)
+            return status
+
+    def get_user_by_status(self, status: int) -> int | None:
+        uid = self._load()["by_status"].get(str(status))
+        return int(uid) if uid is not None else None
+
+    def user_ids_after(self, after_id: int = 0, limit: int = 100) -> list[int]:
+        with _users_lock:
+            data = self._load()
+            if self._ids_of is not data:  # birinchi chaqiruv yoki users.json qayta o'qilgan
+                self._ids, self._ids_of = sorted(int(uid) for uid in data["users"]), data
+            start = bisect_right(self._ids, after_id)
+            return self._ids[start:start + limit]
+
+    def add_bilim_number(self, number: int, message: str, file_id: str | None = None, file_type: str | None = None):
+        with _users_lock:
+            rec = {"op": "bilim_set", "number": str(number), "message": message}
+            if file_id:
+                rec["file_id"], rec["file_type"] = file_id, file_type
+            self._commit(rec)
+
+    def add_bilim_entries(self, entries: list[tuple[int, BilimEntry]]) -> int:
+        """Ko'p yozuv — bitta _persist() bilan."""
+        with self.batch():
+            for number, entry in entries:
+                self.add_bilim_number(number, entry.text, entry.file_id, entry.file_type)
+        return len(entries)
+
+    def delete_bilim_number(self, number: int) -> bool:
+        with _users_lock:
+            key = str(number)
+            if key not in self._load()["bilim"]:
+                return False
+            self._commit({"op": "bilim_del", "number": key})
+            return True
+
+    def bilim_entries(self) -> list[tuple[int, BilimEntry]]:
+        data = self._load()
+        items = []
+        for k, v in data["bilim"].items():
+            try:
+                items.append((int(k), bilim_entry(v)))
+            except ValueError:
+                continue
+        return sorted(items, key=lambda x: x[0])
+
+class JournalUserStore(JsonUserStore):
+    """users.json — snapshot, users.journal — har bir o'zgarish bitta ixcham JSON qatori.
+    Ishga tushishda snapshot + journal qayta o'ynaladi; compact_journal() journalni yangi snapshotga
+    (tmp + rename) yig'adi. Yozish narxi ma'lumot hajmiga bog'liq emas."""
+
+    def __init__(self, journal_path: Path = USERS_JOURNAL):
+        super().__init__()
+        self.journal_path = journal_path
+        self.data = load_users()
+        self.journal_records = self._replay()
+        self._journal = open(journal_path, "a", encoding="utf-8")
+
+    def _replay(self) -> int:
+        if not self.journal_path.exists():
+            return 0
+        count = good_offset = 0
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # "\n" siz oxirgi qator yarim yozilgan — keyingi yozuv unga qo'shilib ketmasin
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break  # oxirgi qator yarim yozilgan (qulash) — undan keyingisi tashlanadi
+                apply_user_record(self.data, rec)
+                good_offset += len(line)
+                count += 1
+        if good_offset != self.journal_path.stat().st_size:
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(good_offset)
+        return count
+
+    def _load(self):
+        return self.data
+
+    def _persist(self, records: list[dict]):
+        offset = os.fstat(self._journal.fileno()).st_size
+        try:
+            self._journal.write("".join(
+                json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n" for rec in records
+            ))
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        except BaseException:
+            self._rollback(offset)
+            raise
+        self.journal_records += len(records)
+
+    def _rollback(self, offset: int):
+        """Yozish xatosi (ENOSPC/EIO): journal yozishdan oldingi uzunligiga qirqiladi va self.data
+        diskdagi holatdan qayta quriladi — aks holda keyingi yozuvlar yarim qator ortidan tushib,
+        replay'da yo'qoladi, xotira esa saqlanmagan o'zgarishlarni ko'rsatadi."""
+        try:
+            self._journal.close()  # buferda qolgan yarim yozuv ham tashlanadi
+        except OSError:
+            pass
+        os.truncate(self.journal_path, offset)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        _users_cache["data"] = None
+        self.data = load_users()
+        self.journal_records = self._replay()
+
+    def compact_snapshot(self) -> tuple[dict, int, int] | None:
+        """Storage oqimida: holat nusxasi va u qamragan journal uzunligi. Yozuvlar ichki dict'larni
+        almashtiradi, o'zgartirmaydi — shuning uchun sayoz nusxa yetarli."""
+        with _users_lock:
+            if not self.journal_records:
+                return None
+            data = {
+                **self.data,
+                "users": dict(self.data["users"]),
+                "by_status": dict(self.data["by_status"]),
+                "bilim": dict(self.data["bilim"]),
+            }
+            return data, os.fstat(self._journal.fileno()).st_size, self.journal_records
+
+    def compact_finish(self, tmp: Path, offset: int, records: int):
+        """Storage oqimida: yangi snapshot o'rnatiladi, journaldan faqat u qamragan qism olib tashlanadi."""
+        with _users_lock:
+            os.replace(tmp, USERS_FILE)
+            _users_cache["data"], _users_cache["sig"] = None, None
+            with open(self.journal_path, "rb") as f:
+                f.seek(offset)
+                tail = f.read()  # snapshotdan keyin yozilganlar
+            journal_tmp = self.journal_path.with_name(self.journal_path.name + ".tmp")
+            with open(journal_tmp, "wb") as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(journal_tmp, self.journal_path)
+            self._journal.close()
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+            self.journal_records -= records
+
+async def compact_journal(store: JournalUserStore) -> bool:
+    """Snapshot storage oqimida olinadi, lekin JSON alohida oqimda yoziladi — katta users.json
+    serializatsiyasi paytida user so'rovlari navbatda turib qolmaydi."""
+    snapshot = await run_storage(store.compact_snapshot)
+    if snapshot is None:
+        return False
+    data, offset, records = snapshot
+    tmp = USERS_FILE.with_name(USERS_FILE.name + ".compact.tmp")
+    await asyncio.to_thread(write_users_file, data, tmp)
+    await run_storage(store.compact_finish, tmp, offset, records)
+    return True
+
+JOURNAL_COMPACT_RECORDS = int(os.getenv("JOURNAL_COMPACT_RECORDS", "1000"))
+JOURNAL_COMPACT_INTERVAL = float(os.getenv("JOURNAL_COMPACT_INTERVAL", "300"))
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    name    TEXT,
+    age     TEXT,
+    region  TEXT,
+    phone   TEXT,
+    status  INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS users_status_idx ON users(status);
+CREATE TABLE IF NOT EXISTS bilim (
+    number    INTEGER PRIMARY KEY,
+    message   TEXT NOT NULL,
+    file_id   TEXT,
+    file_type TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+class SqliteUserStore:
+    """SQLite (WAL) ombori: user_id, status va Bilim raqami bo'yicha indekslangan."""
+
+    def __init__(self, path: Path):
+        self.conn = open_sqlite(path)
+        self.conn.executescript(SQLITE_SCHEMA)
+        if "file_id" not in {row[1] for row in self.conn.execute("PRAGMA table_info(bilim)")}:
+            self.conn.execute("ALTER TABLE bilim ADD COLUMN file_id TEXT")
+            self.conn.execute("ALTER TABLE bilim ADD COLUMN file_type TEXT")
+        self.lock = threading.RLock()
+        self._depth = 0
+
+    @contextmanager
+    def transaction(self):
+        """Tashqi chaqiruv — BEGIN IMMEDIATE/COMMIT, ichkilari — SAVEPOINT."""
+        with self.lock:
+            outer = self._depth == 0
+            self.conn.execute("BEGIN IMMEDIATE" if outer else f"SAVEPOINT sp{self._depth}")
+            self._depth += 1
+            try:
+                yield self.conn
+            except BaseException:
+                self._depth -= 1
+                self.conn.execute("ROLLBACK" if outer else f"ROLLBACK TO sp{self._depth}")
+                if not outer:
+                    self.conn.execute(f"RELEASE sp{self._depth}")
+                raise
+            self._depth -= 1
+            self.conn.execute("COMMIT" if outer else f"RELEASE sp{self._depth}")
+
+    def batch(self):
+        return self.transaction()
+
+    def _meta(self, key: str, default: int | None = None) -> int | None:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def get_user_status(self, user_id: int) -> int | None:
+        with self.lock:
+            row = self.conn.execute("SELECT status FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def register_user(self, user_id: int, name: str, age: str, region: str, phone: str) -> int:
+        with self.transaction() as conn:
+            row = conn.execute("SELECT status FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row:
+                return row[0]  # allaqachon ro'yxatdan o'tgan
+            status = self._meta("next_status", 1)
+            conn.execute(
+                "INSERT INTO users (user_id, name, age, region, phone, status) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, name, age, region, phone, status),
+            )
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_status', ?)", (status + 1,))
+            return status
+
+    def get_user_by_status(self, status: int) -> int | None:
+        with self.lock:
+            row = self.conn.execute("SELECT user_id FROM users WHERE status = ?", (status,)).fetchone()
+        return row[0] if row else None
+
+    def user_ids_after(self, after_id: int = 0, limit: int = 100) -> list[int]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after_id, limit)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def add_bilim_number(self, number: int, message: str, file_id: str | None = None, file_type: str | None = None):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO bilim (number, message, file_id, file_type) VALUES (?, ?, ?, ?)",
+                (number, message, file_id, file_type),
+            )
+
+    def add_bilim_entries(self, entries: list[tuple[int, BilimEntry]]) -> int:
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO bilim (number, message, file_id, file_type) VALUES (?, ?, ?, ?)",
+                [(n, e.text, e.file_id, e.file_type) for n, e in entries],
+            )
+        return len(entries)
+
+    def delete_bilim_number(self, number: int) -> bool:
+        with self.transaction() as conn:
+            return conn.execute("DELETE FROM bilim WHERE number = ?", (number,)).rowcount > 0
+
+    def bilim_entries(self) -> list[tuple[int, BilimEntry]]:
+        with self.lock:
+            rows = self.conn.execute("SELECT number, message, file_id, file_type FROM bilim ORDER BY number").fetchall()
+        return [(n, BilimEntry(m, f, t)) for n, m, f, t in rows]
+
+def migrate_json_to_sqlite(store: SqliteUserStore, json_path: Path = USERS_FILE) -> bool:
+    """users.json ni SQLite ga bir marta ko'chirish. Ko'chirilgan bo'lsa True."""
+    with store.transaction() as conn:
+        if store._meta("migrated_from_json") or not json_path.exists():
+            return False
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, name, age, region, phone, status) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (int(uid), u.get("name"), u.get("age"), u.get("region"), u.get("phone"), u["status"])
+                for uid, u in data.get("users", {}).items()
+            ],
+        )
+        entries = [(int(k), bilim_entry(v)) for k, v in data.get("bilim", {}).items() if k.isdigit()]
+        conn.executemany(
+            "INSERT OR REPLACE INTO bilim (number, message, file_id, file_type) VALUES (?, ?, ?, ?)",
+            [(n, e.text, e.file_id, e.file_type) for n, e in entries],
+        )
+        next_status = max(data.get("next_status", 1), (conn.execute("SELECT MAX(status) FROM users").fetchone()[0] or 0) + 1)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_status', ?)", (next_status,))
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from_json', 1)")
         return True
-    return False
 
-def get_bilim_message(number: int) -> str | None:
-    data = load_users()
-    return data["bilim"].get(str(number))
-
-def list_bilim_numbers() -> list[tuple[int, str]]:
-    data = load_users()
-    items = []
-    for k, v in data["bilim"].items():
+def create_user_store():
+    if STORAGE_BACKEND == "sqlite":
+        store = SqliteUserStore(DB_FILE)
+        if migrate_json_to_sqlite(store):
+            log.info("users.json -> %s ko'chirildi", DB_FILE.name)
+        return store
+    if STORAGE_BACKEND == "journal":
+        return JournalUserStore()
+    if STORAGE_BACKEND != "json":
+        raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return JsonUserStore()
+
+user_store = create_user_store()
+
+# ===================== ASYNC STORAGE =====================
+# Handlerlar faqat shu fasadni await qiladi: disk ishi alohida (bitta) oqimda bajariladi,
+# event loop boshqa userlarning update'larini to'xtovsiz qayta ishlaydi.
+storage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+
+async def run_storage(fn, *args):
+    timing = _update_timing.get()
+    if timing is None:
+        return await asyncio.get_running_loop().run_in_executor(storage_executor, fn, *args)
+    start = perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(storage_executor, fn, *args)
+    finally:
+        timing.storage += perf_counter() - start
+
+STORAGE_COMMIT_WINDOW = float(os.getenv("STORAGE_COMMIT_WINDOW", "0.05"))
+
+class BilimIndex:
+    """Bilim Ulash xaritasi xotirada (raqam -> BilimEntry) va raqamlarning tartiblangan ro'yxati.
+    Faqat AsyncUserStore.add/delete_bilim_number orqali, diskka yozilgandan keyin yangilanadi;
+    har o'zgarishda version oshadi."""
+    __slots__ = ("entries", "numbers", "version")
+
+    def __init__(self, items=()):
+        self.entries: dict[int, BilimEntry] = dict(items)
+        self.numbers: list[int] = sorted(self.entries)
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, number: int) -> BilimEntry | None:
+        return self.entries.get(number)
+
+    def set(self, number: int, entry: BilimEntry):
+        if number not in self.entries:
+            insort(self.numbers, number)
+        self.entries[number] = entry
+        self.version += 1
+
+    def discard(self, number: int):
+        if self.entries.pop(number, None) is not None:
+            del self.numbers[bisect_left(self.numbers, number)]
+            self.version += 1
+
+    def page(self, after: int | None = None, before: int | None = None, limit: int = 20) -> tuple[list[tuple[int, BilimEntry]], bool, bool]:
+        """Keyset sahifa: (yozuvlar, oldingi sahifa bormi, keyingi sahifa bormi).
+        after/before — qat'iy undan keyingi/oldingi raqamlar (⬅️/➡️ tugmalari)."""
+        if before is not None:
+            end = bisect_left(self.numbers, before)
+            start = max(0, end - limit)
+        else:
+            start = bisect_right(self.numbers, after) if after is not None else 0
+            end = start + limit
+        return self._slice(start, end)
+
+    def page_at(self, number: int, limit: int = 20) -> tuple[list[tuple[int, BilimEntry]], bool, bool]:
+        """"Raqamga o'tish": number dan boshlanadigan sahifa; oxiridan keyin bo'lsa — oxirgi sahifa."""
+        start = min(bisect_left(self.numbers, number), max(0, len(self.numbers) - limit))
+        return self._slice(start, start + limit)
+
+    def _slice(self, start: int, end: int) -> tuple[list[tuple[int, BilimEntry]], bool, bool]:
+        numbers = self.numbers[start:end]
+        return [(n, self.entries[n]) for n in numbers], start > 0, end < len(self.numbers)
+
+class AsyncUserStore:
+    """Yozuvlar guruhlanadi (group commit): commit_window ichida kelgan o'zgarishlar
+    storage oqimida ketma-ket qo'llanadi va bitta store.batch() bilan yoziladi.
+    Tartib raqamlari shu yagona oqimda ajratiladi — takrorlanmaydi va o'sib boradi."""
+
+    def __init__(self, store, commit_window: float = STORAGE_COMMIT_WINDOW):
+        self.store = store
+        self.commit_window = commit_window
+        self.bilim = BilimIndex(store.bilim_entries())
+        self._pending: list = []
+        self._flush_task: asyncio.Task | None = None
+
+    async def _write(self, fn, *args):
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((fn, args, fut))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        timing = _update_timing.get()
+        if timing is None:
+            return await fut
+        start = perf_counter()  # yozuv kutgan update'ga hisoblanadi, flush vazifasiga emas
         try:
-            items.append((int(k), v))
-        except ValueError:
-            continue
-    return sorted(items, key=lambda x: x[0])
+            return await fut
+        finally:
+            timing.storage += perf_counter() - start
+
+    async def _flush_later(self):
+        _update_timing.set(None)
+        await asyncio.sleep(self.commit_window)
+        batch, self._pending = self._pending, []
+        self._flush_task = None
+        try:
+            results = await run_storage(self._apply_batch, batch)
+        except Exception as e:
+            results = [(False, e)] * len(batch)
+        for (_, _, fut), (ok, value) in zip(batch, results):
+            if fut.done():
+                continue
+            if ok:
+                fut.set_result(value)
+            else:
+                fut.set_exception(value)
+
+    def _apply_batch(self, batch) -> list[tuple[bool, object]]:
+        results = []
+        with self.store.batch():
+            for fn, args, _ in batch:
+                try:
+                    results.append((True, fn(*args)))
+                except Exception as e:
+                    results.append((False, e))
+        return results
+
+    async def get_user_status(self, user_id: int) -> int | None:
+        return await run_storage(self.store.get_user_status, user_id)
+
+    async def register_user(self, user_id: int, name: str, age: str, region: str, phone: str) -> int:
+        return await self._write(self.store.register_user, user_id, name, age, region, phone)
+
+    async def get_user_by_status(self, status: int) -> int | None:
+        return await run_storage(self.store.get_user_by_status, status)
+
+    async def user_ids_after(self, after_id: int = 0, limit: int = 100) -> list[int]:
+        """Ro'yxatdan o'tgan user_id lar, o'sish tartibida (after_id dan keyin) — ro'yxatni bo'laklab o'qish uchun."""
+        return await run_storage(self.store.user_ids_after, after_id, limit)
+
+    async def add_bilim_number(self, number: int, message: str, file_id: str | None = None, file_type: str | None = None):
+        await self._write(self.store.add_bilim_number, number, message, file_id, file_type)
+        self.bilim.set(number, BilimEntry(message, file_id, file_type))
+
+    async def add_bilim_entries(self, entries: list[tuple[int, BilimEntry]]) -> int:
+        """Import: barcha yozuvlar bitta tranzaksiyada (xato bo'lsa hech biri yozilmaydi)."""
+        count = await self._write(self.store.add_bilim_entries, entries)
+        for number, entry in entries:
+            self.bilim.set(number, entry)
+        return count
+
+    async def delete_bilim_number(self, number: int) -> bool:
+        deleted = await self._write(self.store.delete_bilim_number, number)
+        self.bilim.discard(number)
+        return deleted
+
+db = AsyncUserStore(user_store)
+
+async def journal_compactor(store: JournalUserStore, check_every: float = 10.0):
+    """Journal yetarlicha o'sganda yoki JOURNAL_COMPACT_INTERVAL o'tganda snapshotga yig'adi."""
+    last = monotonic()
+    while True:
+        await asyncio.sleep(check_every)
+        records = store.journal_records
+        if records >= JOURNAL_COMPACT_RECORDS or (records and monotonic() - last >= JOURNAL_COMPACT_INTERVAL):
+            try:
+                await compact_journal(store)
+            except Exception:
+                log.exception("Journal compaction xatosi")
+            last = monotonic()
+
+# ===================== USER CONTEXT =====================
+# Har bir update uchun user yozuvi bir marta o'qiladi va handlerlarga `user_record` sifatida beriladi.
+@dataclass(frozen=True, slots=True)
+class UserRecord:
+    user_id: int
+    status: int | None
+    is_admin: bool
+
+    @property
+    def registered(self) -> bool:
+        return self.status is not None
+
+class UserRecordMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None:
+            data["user_record"] = UserRecord(user.id, await db.get_user_status(user.id), user.id == ADMIN_ID)
+            if user.id in broadcaster.blocked:
+                await broadcaster.unblock(user.id)  # yozgan bo'lsa — botni blokdan chiqargan
+        return await handler(event, data)
+
+# ===================== ORDERS =====================
+# Har bir to'lov cheki orders jadvaliga yoziladi; admin tugmalari faqat buyurtma id sini tashiydi.
+# Holat o'zgarishi (pending -> approved/declined) bitta shartli UPDATE — ikki marta bosish ta'sirsiz.
+class OrderStore:
+    def __init__(self, path: Path):
+        self.conn = open_sqlite(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS orders (
+                id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id       INTEGER NOT NULL,
+                status_msg_id INTEGER NOT NULL,
+                kind          TEXT NOT NULL,
+                fields        TEXT NOT NULL,
+                price         INTEGER,
+                receipt_id    TEXT,
+                receipt_type  TEXT,
+                status        TEXT NOT NULL DEFAULT 'pending',
+                created       REAL NOT NULL,
+                updated       REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS orders_status_idx ON orders(status, id);
+            CREATE INDEX IF NOT EXISTS orders_user_idx ON orders(user_id);
+        """)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _row(row) -> dict | None:
+        if row is None:
+            return None
+        order = dict(row)
+        order["fields"] = json.loads(order["fields"])
+        return order
+
+    def _create(self, user_id: int, status_msg_id: int, kind: str, fields: dict, price,
+                receipt_id: str | None, receipt_type: str | None) -> int:
+        now = time()
+        with self.lock:
+            return self.conn.execute(
+                "INSERT INTO orders (user_id, status_msg_id, kind, fields, price, receipt_id, receipt_type, created, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, status_msg_id, kind, json.dumps(fields, ensure_ascii=False), price,
+                 receipt_id, receipt_type, now, now),
+            ).lastrowid
+
+    def _get(self, order_id: int) -> dict | None:
+        with self.lock:
+            return self._row(self.conn.execute("SELECT * FROM orders WHERE id = ?", (order_id,)).fetchone())
+
+    def _transition(self, order_id: int, new_status: str, from_status: str, locked: bool = False) -> dict | None:
+        if not locked:
+            with self.lock:
+                return self._transition(order_id, new_status, from_status, locked=True)
+        changed = self.conn.execute(
+            "UPDATE orders SET status = ?, updated = ? WHERE id = ? AND status = ?",
+            (new_status, time(), order_id, from_status),
+        ).rowcount
+        if not changed:
+            return None
+        return self._row(self.conn.execute("SELECT * FROM orders WHERE id = ?", (order_id,)).fetchone())
+
+    def _page(self, status: str, after_id: int = 0, before_id: int | None = None, limit: int = 10) -> list[dict]:
+        # Keyset pagination: (status, id) indeksi bo'yicha — sahifa narxi OFFSET ga bog'liq emas
+        with self.lock:
+            if before_id is not None:
+                rows = self.conn.execute(
+                    "SELECT * FROM orders WHERE status = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                    (status, before_id, limit),
+                ).fetchall()[::-1]
+            else:
+                rows = self.conn.execute(
+                    "SELECT * FROM orders WHERE status = ? AND id > ? ORDER BY id LIMIT ?",
+                    (status, after_id, limit),
+                ).fetchall()
+        return [self._row(r) for r in rows]
+
+    def _count(self, status: str) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM orders WHERE status = ?", (status,)).fetchone()[0]
+
+    def _exists(self, status: str, after_id: int = 0, before_id: int | None = None) -> bool:
+        with self.lock:
+            if before_id is not None:
+                sql, param = "SELECT 1 FROM orders WHERE status = ? AND id < ? LIMIT 1", before_id
+            else:
+                sql, param = "SELECT 1 FROM orders WHERE status = ? AND id > ? LIMIT 1", after_id
+            return self.conn.execute(sql, (status, param)).fetchone() is not None
+
+    def _transition_many(self, order_ids: list[int], new_status: str, from_status: str) -> list[dict]:
+        changed = []
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for order_id in order_ids:
+                    order = self._transition(order_id, new_status, from_status, locked=True)
+                    if order:
+                        changed.append(order)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+        return changed
+
+    async def create(self, user_id: int, status_msg_id: int, kind: str, fields: dict, price=None,
+                     receipt_id: str | None = None, receipt_type: str | None = None) -> int:
+        return await run_storage(self._create, user_id, status_msg_id, kind, fields, price, receipt_id, receipt_type)
+
+    async def get(self, order_id: int) -> dict | None:
+        return await run_storage(self._get, order_id)
+
+    async def transition(self, order_id: int, new_status: str, from_status: str = "pending") -> dict | None:
+        """from_status dagi buyurtmani new_status ga o'tkazadi; o'tmasa None."""
+        return await run_storage(self._transition, order_id, new_status, from_status)
+
+    async def transition_many(self, order_ids: list[int], new_status: str, from_status: str = "pending") -> list[dict]:
+        """Bitta tranzaksiyada; faqat haqiqatan o'tgan buyurtmalar qaytariladi."""
+        return await run_storage(self._transition_many, order_ids, new_status, from_status)
+
+    async def page(self, status: str = "pending", after_id: int = 0, before_id: int | None = None,
+                   limit: int = 10) -> tuple[list[dict], bool, bool]:
+        """(buyurtmalar, oldingi sahifa bormi, keyingi sahifa bormi)."""
+        def load():
+            items = self._page(status, after_id, before_id, limit)
+            if not items:
+                return items, False, False
+            return items, self._exists(status, before_id=items[0]["id"]), self._exists(status, after_id=items[-1]["id"])
+        return await run_storage(load)
+
+    async def count(self, status: str = "pending") -> int:
+        return await run_storage(self._count, status)
+
+orders = OrderStore(DB_FILE)
+
+def receipt_of(photo_id: str | None, doc_id: str | None) -> tuple[str | None, str | None]:
+    if photo_id:
+        return photo_id, "photo"
+    if doc_id:
+        return doc_id, "document"
+    return None, None
 
 # ===================== STATES =====================
 class SubState(StatesGroup):
@@ -188,6 +1704,13 @@ class AdminSendState(StatesGroup):
     file = State()
     user_number = State()
     comment = State()
+    batch_files = State()
+    batch_numbers = State()
+    batch_comment = State()
+
+class BroadcastState(StatesGroup):
+    message = State()
+    confirm = State()
 
 class BilimUlashUserState(StatesGroup):
     user_number = State()
@@ -196,52 +1719,231 @@ class BilimUlashAdminState(StatesGroup):
     add_number = State()
     add_message = State()
     del_number = State()
+    jump_number = State()
+    import_file = State()
+
+# ===================== CALLBACK DATA =====================
+class RegBack(CallbackData, prefix="reg_back"):
+    step: str
+
+class SlideBack(CallbackData, prefix="back_slide"):
+    step: str
+
+class VideoBack(CallbackData, prefix="back_ai"):
+    step: str
+
+class BroadcastStop(CallbackData, prefix="broadcast_stop"):
+    broadcast_id: int
+
+class BilimPage(CallbackData, prefix="bilim_page"):
+    dir: str  # "next" — anchor dan keyingilar, "prev" — oldingilar
+    anchor: int
+
+class OrdersPage(CallbackData, prefix="orders_page"):
+    dir: str
+    anchor: int
+
+class OrderSelect(CallbackData, prefix="order_sel"):
+    order_id: int
+
+class OrderAction(CallbackData, prefix="order"):
+    action: str  # ORDER_ACTIONS kaliti: "ok" | "no"
+    order_id: int
+
+class LegacyStep(Filter):
+    """Deploydan oldin yuborilgan "{prefix}{qadam}" tugmalari (masalan reg_back_age) — yangi
+    callback_data bilan bir xil handlerga tushadi, oqim o'rtasidagi userlar uchun ham ishlaydi."""
+
+    def __init__(self, factory: type[CallbackData], prefix: str):
+        self.factory = factory
+        self.prefix = prefix
+
+    async def __call__(self, call: CallbackQuery):
+        data = call.data or ""
+        if not data.startswith(self.prefix):
+            return False
+        return {"callback_data": self.factory(step=data[len(self.prefix):])}
 
 # ===================== KEYBOARDS =====================
+# Klaviaturalar o'zgarmas — har biri bir marta quriladi va keshdan qaytariladi.
+BTN_BILIM = "📚 Bilim Ulash"
+BTN_SLIDE = "📝 Slayd buyurtma"
+BTN_VIDEO = "🎥 AI Video"
+BTN_CONTACT = "🧑‍💼 Admin bilan bog'lanish"
+BTN_BOT = "🤖 Bot yaratib berish"
+BTN_ADMIN = "⚙️ Admin panel"
+
+@cache
 def menu_kb(is_admin: bool = False):
     rows = [
-        [KeyboardButton(text="📚 Bilim Ulash")],
-        [KeyboardButton(text="📝 Slayd buyurtma")],
-        [KeyboardButton(text="🎥 AI Video")],
-        [KeyboardButton(text="🧑‍💼 Admin bilan bog'lanish")],
-        [KeyboardButton(text="🤖 Bot yaratib berish")],
+        [KeyboardButton(text=BTN_BILIM)],
+        [KeyboardButton(text=BTN_SLIDE)],
+        [KeyboardButton(text=BTN_VIDEO)],
+        [KeyboardButton(text=BTN_CONTACT)],
+        [KeyboardButton(text=BTN_BOT)],
     ]
     if is_admin:
-        rows.append([KeyboardButton(text="⚙️ Admin panel")])
+        rows.append([KeyboardButton(text=BTN_ADMIN)])
     return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
 
+@cache
 def sub_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Obuna bo'lish", url="https://t.me/bilimulash_kanal")],
         [InlineKeyboardButton(text="Obuna boldim", callback_data="check_sub")],
     ])
 
+@cache
 def back_kb(callback_data: str):
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⬅️ Orqaga qaytish", callback_data=callback_data)],
     ])
 
+@cache
+def ai_menu_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🖼️ Rasmni video qilish", callback_data="ai_img_to_video")],
+        [InlineKeyboardButton(text="🎨 Rasm yaratish", callback_data="ai_image_gen")],
+        [InlineKeyboardButton(text="🎬 Men hohlagan video", callback_data="ai_custom_video")],
+    ])
+
+@cache
 def admin_panel_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔢 Raqamlar", callback_data="admin_numbers")],
+        [InlineKeyboardButton(text="🧾 Buyurtmalar", callback_data="admin_orders")],
         [InlineKeyboardButton(text="📦 Buyurtma tayyor", callback_data="admin_order_ready")],
+        [InlineKeyboardButton(text="📣 Hammaga xabar", callback_data="admin_broadcast")],
         [InlineKeyboardButton(text="⬅️ Orqaga qaytish", callback_data="admin_back_main")],
     ])
 
+@cache
+def order_ready_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📚 Bir nechta fayl", callback_data="admin_send_batch")],
+        [InlineKeyboardButton(text="⬅️ Orqaga qaytish", callback_data="admin_back_send")],
+    ])
+
+@cache
 def admin_numbers_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Raqam qo'shish", callback_data="admin_numbers_add")],
         [InlineKeyboardButton(text="🗑️ Raqam o'chirish", callback_data="admin_numbers_delete")],
+        [InlineKeyboardButton(text="📥 Import", callback_data="admin_numbers_import"),
+         InlineKeyboardButton(text="📤 Eksport", callback_data="admin_numbers_export")],
         [InlineKeyboardButton(text="⬅️ Orqaga qaytish", callback_data="admin_back_main")],
     ])
 
+# ===================== NAVIGATSIYA (oqim qadamlari) =====================
+# Har bir oqim uchun qadam -> (holat, savol, "Orqaga" tugmasi) jadvali importda bir marta quriladi.
+# Oldinga handlerlar ham, "Orqaga" callback'lari ham savol va tugmani shu jadvaldan oladi.
+@dataclass(frozen=True, slots=True)
+class FlowStep:
+    state: State
+    text: str
+    markup: InlineKeyboardMarkup
+    reset: str | None = None  # orqaga qaytilganda tozalanadigan maydon
+    clear: bool = False
+
+REG_STEPS = {
+    "sub": FlowStep(SubState.waiting_check, " Botdan to'liq foydalanish uchun kanalga obuna bo'ling:", sub_kb(), clear=True),
+    "name": FlowStep(RegState.name, "👤  Ism va familiyangizni yozing:", back_kb(RegBack(step="sub").pack()), reset="age"),
+    "age": FlowStep(RegState.age, "🎂  Yoshingiz nechida?", back_kb(RegBack(step="name").pack()), reset="region"),
+    "region": FlowStep(RegState.region, "📍  Qaysi viloyatdan?", back_kb(RegBack(step="age").pack()), reset="phone"),
+    "phone": FlowStep(RegState.phone, "📞  Telefon raqamingizni yozing:", back_kb(RegBack(step="region").pack())),
+}
+
+SLIDE_STEPS = {
+    "topic": FlowStep(SlideState.topic, "📌  Slayd mavzusini yozing:", back_kb("back_to_menu")),
+    "pages": FlowStep(SlideState.pages, "📄  Necha varaq bo'lsin?", back_kb(SlideBack(step="topic").pack())),
+    "colors": FlowStep(SlideState.colors, "🎨  Qaysi ranglar ko'p bo'lsin?", back_kb(SlideBack(step="pages").pack())),
+    "text": FlowStep(SlideState.text_amount, "📝  Matn qanchalik ko'p bo'lsin? (kam / o'rtacha / ko'p)",
+                     back_kb(SlideBack(step="colors").pack())),
+    "deadline": FlowStep(SlideState.deadline, "⏰ ? Qancha vaqtda tayyor bo'lsin? (minimal 2 soat)",
+                         back_kb(SlideBack(step="text").pack())),
+    "format": FlowStep(SlideState.format, "📂  Qaysi formatda bo'lsin? (pdf / ppt / word / boshqasi)",
+                       back_kb(SlideBack(step="deadline").pack())),
+}
+
+VIDEO_STEPS = {
+    "menu": FlowStep(VideoState.menu, "👇 Xizmat turini tanlang:", ai_menu_kb()),
+    "image": FlowStep(VideoState.img_to_video_image, "? Video yaratmoqchi bo'lgan rasmni yuboring:",
+                      back_kb(VideoBack(step="menu").pack())),
+    "prompt": FlowStep(VideoState.img_to_video_prompt,
+                       " Sizga qanaqa video kerak? Shunchaki yozing."
+                       "Misol uchun: rasmdagi odam nimadir deb gapirsin.",
+                       back_kb(VideoBack(step="image").pack())),
+    "imagegen_prompt": FlowStep(VideoState.image_gen_prompt,
+                                " Yaratmoqchi bo'lgan rasmingizni shunchaki tasvirlab bering."
+                                "Misol uchun: bir yosh yigit korzinka supermarketi yonida qo'lida kamera bilan turibdi va futbolkasida instagram akkaunti nomi yozilgan..."
+                                "Shu kabi hohlagan narsangizni yozing, sifatli rasm tayyorlash mendan :)",
+                                back_kb(VideoBack(step="menu").pack())),
+    "imagegen_format": FlowStep(VideoState.image_gen_format,
+                                "Rasm qanaqa formatda bo'lsin? (Instagram stories / kvadrat / YouTube format va hokazo)",
+                                back_kb(VideoBack(step="imagegen_prompt").pack())),
+    "custom": FlowStep(VideoState.custom_prompt,
+                       "  Video haqida xohishingizni yozing."
+                       "  Qisqa va tushunarli yozing.",
+                       back_kb(VideoBack(step="menu").pack())),
+}
+
+async def ask_step(msg: Message, state: FSMContext, step: FlowStep):
+    await msg.answer(step.text, reply_markup=step.markup)
+    await state.set_state(step.state)
+
+async def back_to_step(call: CallbackQuery, state: FSMContext, step: FlowStep):
+    await delete_last_user_message(state)
+    await call.answer()  # darhol tugmani "yuklangan" holatdan chiqarish
+    if step.clear:
+        await state.clear()
+    elif step.reset:
+        await state.update_data({step.reset: None})
+    await state.set_state(step.state)
+    try:
+        await call.message.delete()
+    except Exception:
+        pass
+    await call.message.answer(step.text, reply_markup=step.markup)
+
+# ===================== MENYU (tugmalar va buyruqlar) =====================
+# Menyu tugmalari va buyruqlar MENU_ROUTES lug'atidan (faylning oxirida) aniq matn bo'yicha topiladi.
+# Oddiy FSM javoblari uchun narx — bitta dict qidiruvi. Marshrut yields_to dagi holatlarda
+# (yoki yields_any bo'lsa istalgan holatda) o'sha holat handleriga yo'l beradi; hech kim olmasa —
+# oxirdagi menu_fallback ishlaydi.
+@dataclass(frozen=True, slots=True)
+class MenuRoute:
+    handler: object
+    yields_to: frozenset[str] = frozenset()
+    yields_any: bool = False
+    takes_args: bool = False  # "/buyruq argument" ko'rinishida ham
+
+class MenuButton(Filter):
+    def __init__(self, front: bool = True):
+        self.front = front
+
+    async def __call__(self, message: Message, raw_state: str | None = None):
+        text = message.text
+        route = MENU_ROUTES.get(text)
+        if route is None and text and text[0] == "/":
+            route = MENU_ROUTES.get(text.split(maxsplit=1)[0])
+            if route is not None and not route.takes_args:
+                route = None
+        if route is None:
+            return False
+        if self.front and raw_state is not None and (route.yields_any or raw_state in route.yields_to):
+            return False
+        return {"menu_route": route}
+
+@dp.message(MenuButton())
+async def menu_front(msg: Message, state: FSMContext, user_record: UserRecord, menu_route: MenuRoute):
+    await menu_route.handler(msg, state, user_record)
+
 # ===================== START + BANNER + OBUNA =====================
-@dp.message(F.text == "/start")
-async def start(msg: Message, state: FSMContext):
+async def start(msg: Message, state: FSMContext, user_record: UserRecord):
     await state.clear()
     # Agar allaqachon ro'yxatdan o'tgan bo'lsa - menyu
-    if is_registered(msg.from_user.id):
-        await msg.answer("Xizmatni tanlang 👇", reply_markup=menu_kb(msg.from_user.id == ADMIN_ID))
+    if user_record.registered:
+        await msg.answer("Xizmatni tanlang 👇", reply_markup=menu_kb(user_record.is_admin))
         return
     # Banner (bot nima qiladi)
     await msg.answer(BANNER, parse_mode="Markdown")
@@ -254,10 +1956,9 @@ async def start(msg: Message, state: FSMContext):
 
 
 # ===================== ADMIN PANEL (START dan keyin, boshqa handlerlardan oldin) =====================
-@dp.message((F.text == "/admin") | (F.text.contains("Admin panel")))
-async def admin_panel_first(msg: Message, state: FSMContext):
+async def admin_panel_first(msg: Message, state: FSMContext, user_record: UserRecord):
     """Admin panel — faqat admin uchun."""
-    if msg.from_user.id != ADMIN_ID:
+    if not user_record.is_admin:
         return
     await state.clear()
     await msg.answer(
@@ -265,113 +1966,190 @@ async def admin_panel_first(msg: Message, state: FSMContext):
         reply_markup=admin_panel_kb()
     )
 
-async def check_subscription(user_id: int) -> bool:
+async def admin_broadcast_cmd(msg: Message, state: FSMContext, user_record: UserRecord):
+    if not user_record.is_admin:
+        return
+    await state.clear()
+    await ask_broadcast_message(msg, state)
+
+# Obuna natijasi keshlanadi: ijobiy — SUB_CACHE_TTL, salbiy — SUB_NEGATIVE_TTL soniya.
+# Bir user uchun bir vaqtdagi tekshiruvlar bitta get_chat_member so'roviga birlashtiriladi.
+SUB_CACHE_TTL = float(os.getenv("SUB_CACHE_TTL", "300"))
+SUB_NEGATIVE_TTL = float(os.getenv("SUB_NEGATIVE_TTL", "3"))
+SUB_CACHE_SIZE = 10000
+_sub_cache: OrderedDict[int, tuple[bool, float]] = OrderedDict()  # user_id -> (obuna, tekshirilgan vaqt)
+_sub_inflight: dict[int, asyncio.Task] = {}
+
+async def _fetch_subscription(user_id: int) -> bool:
     try:
         m = await bot.get_chat_member(chat_id=CHANNEL, user_id=user_id)
-        return m.status in (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR)
     except Exception:
-        return False
+        # API xatosi — oxirgi ma'lum natija (bo'lmasa False)
+        cached = _sub_cache.get(user_id)
+        return cached[0] if cached else False
+    subscribed = m.status in (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR)
+    _sub_cache.pop(user_id, None)
+    _sub_cache[user_id] = (subscribed, monotonic())
+    if len(_sub_cache) > SUB_CACHE_SIZE:
+        _sub_cache.popitem(last=False)
+    return subscribed
+
+async def check_subscription(user_id: int) -> bool:
+    cached = _sub_cache.get(user_id)
+    if cached and monotonic() - cached[1] < (SUB_CACHE_TTL if cached[0] else SUB_NEGATIVE_TTL):
+        return cached[0]
+    task = _sub_inflight.get(user_id)
+    if task is None:
+        task = asyncio.create_task(_fetch_subscription(user_id))
+        _sub_inflight[user_id] = task
+        task.add_done_callback(lambda _: _sub_inflight.pop(user_id, None))
+    return await asyncio.shield(task)
 
 @dp.callback_query(SubState.waiting_check, F.data == "check_sub")
 async def check_sub_cb(call: CallbackQuery, state: FSMContext):
     if await check_subscription(call.from_user.id):
         await call.message.edit_text("✅ Obuna tasdiqlandi! Endi ro'yxatdan o'ting.")
-        await call.message.answer("👤  Ism va familiyangizni yozing:", reply_markup=back_kb("reg_back_sub"))
-        await state.set_state(RegState.name)
+        await ask_step(call.message, state, REG_STEPS["name"])
     else:
         await call.answer("Siz kanalga obuna bo'lmagansiz. Avval obuna bo'ling.", show_alert=True)
 
 # ===================== RO'YXATDAN O'TISH (Orqaga qaytish) =====================
 # reg_router ga yoziladi — dp.include_router(reg_router) birinchi, shuning uchun birinchi tekshiriladi
-@reg_router.callback_query(F.data.startswith("reg_back_"))
-async def reg_back_any(call: CallbackQuery, state: FSMContext):
-    await delete_last_user_message(state)
-    await call.answer()  # darhol tugmani "yuklangan" holatdan chiqarish
-    data = call.data.strip()
-
-    if data == "reg_back_sub":
-        await state.clear()
-        await state.set_state(SubState.waiting_check)
-        text = " Botdan to'liq foydalanish uchun kanalga obuna bo'ling:"
-        markup = sub_kb()
-    elif data == "reg_back_name":
-        await state.update_data(age=None)
-        await state.set_state(RegState.name)
-        text = "👤  Ism va familiyangizni yozing:"
-        markup = back_kb("reg_back_sub")
-    elif data == "reg_back_age":
-        await state.update_data(region=None)
-        await state.set_state(RegState.age)
-        text = "🎂  Yoshingiz nechida?"
-        markup = back_kb("reg_back_name")
-    elif data == "reg_back_region":
-        await state.update_data(phone=None)
-        await state.set_state(RegState.region)
-        text = "📍  Qaysi viloyatdan?"
-        markup = back_kb("reg_back_age")
-    else:
+@reg_router.callback_query(RegBack.filter())
+@reg_router.callback_query(LegacyStep(RegBack, "reg_back_"))
+async def reg_back_any(call: CallbackQuery, state: FSMContext, callback_data: RegBack):
+    step = REG_STEPS.get(callback_data.step)
+    if step is None:
+        await call.answer()
         return
-
-    try:
-        await call.message.delete()
-    except Exception:
-        pass
-    await call.message.answer(text, reply_markup=markup)
+    await back_to_step(call, state, step)
 
 
-dp.include_router(priority_router)
 dp.include_router(reg_router)  # ro'yxat orqaga qaytish birinchi tekshirilsin
 
-# Anti-flood
-dp.message.middleware(ThrottleMiddleware(min_interval=0.7, warn_interval=2.0))
+# Anti-flood (xabarlar va inline tugmalar)
+throttle = ThrottleMiddleware(warn_interval=2.0)
+dp.message.middleware(throttle)
+dp.callback_query.middleware(throttle)
+# Ichki middleware — throttle tashlagan update'lar uchun storage'ga bormaydi
+dp.message.middleware(UserRecordMiddleware())
+dp.callback_query.middleware(UserRecordMiddleware())
+
+dp.update.outer_middleware(SlowUpdateMiddleware())
+dp.message.middleware(UpdateLabelMiddleware())
+dp.callback_query.middleware(UpdateLabelMiddleware())
+
+if METRICS_PORT:
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
 
 # ===================== DEBUG =====================
-@priority_router.message(F.text == "/ping")
-async def debug_ping(msg: Message):
+async def debug_ping(msg: Message, state: FSMContext, user_record: UserRecord):
     await msg.answer("pong")
 
+def format_slow_updates(records) -> str:
+    now = time()
+    lines = [
+        f"{elapsed * 1000:.0f} ms | {t.handler} | {t.state} | storage {t.storage * 1000:.0f} ms | "
+        f"api {t.api * 1000:.0f} ms | {(now - at) / 60:.0f} daqiqa oldin"
+        for at, elapsed, t in records
+    ]
+    return "\n".join(lines) if lines else "(yo'q)"
+
+async def debug_slow(msg: Message, state: FSMContext, user_record: UserRecord):
+    if not user_record.is_admin:
+        return
+    text = (
+        f"🐢 Eng sekin update'lar (>{SLOW_UPDATE_MS:.0f} ms, oxirgi {SLOW_WINDOW / 60:.0f} daqiqa):\n\n"
+        + format_slow_updates(slow_updates.top())
+    )
+    cache = users_cache_stats()
+    if cache["hits"] or cache["misses"]:  # faqat json backend
+        text += f"\n\n💾 users.json keshi: {cache['hit_rate']:.1%} ({cache['hits']} hit / {cache['misses']} miss)"
+    await msg.answer(text)
+
+_profile_tasks: set[asyncio.Task] = set()
+
+def _profile_done(task: asyncio.Task):
+    _profile_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("Profil hisobotini yuborib bo'lmadi", exc_info=task.exception())
+
+async def profile_and_report(chat_id: int, seconds: int):
+    _update_timing.set(None)  # /profile update'idan meros qolgan kontekst
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    report = io.StringIO()
+    report.write(f"cProfile: {seconds} s, event loop oqimi\n\nSekin update'lar:\n")
+    report.write(format_slow_updates(slow_updates.top()) + "\n\n")
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(80)
+    with send_priority(PRIORITY_ADMIN):
+        await bot.send_document(
+            chat_id,
+            BufferedInputFile(report.getvalue().encode("utf-8"), filename=f"profile_{int(time())}.txt"),
+            caption=f"📊 Profil ({seconds} s)",
+        )
+
+async def debug_profile(msg: Message, state: FSMContext, user_record: UserRecord):
+    """/profile [soniya] — cProfile ni N soniya yoqib, hisobotni hujjat qilib yuborish."""
+    if not user_record.is_admin:
+        return
+    parts = msg.text.split()
+    seconds = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 30
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    if _profile_tasks:  # hisobot yuborilguncha yangisi boshlanmaydi
+        await msg.answer("⏳ Profil allaqachon yozilmoqda.")
+        return
+    task = asyncio.create_task(profile_and_report(msg.chat.id, seconds))
+    _profile_tasks.add(task)
+    task.add_done_callback(_profile_done)
+    await msg.answer(f"📊 Profil {seconds} soniya yoziladi, keyin hisobot yuboriladi.")
+
 @dp.message(RegState.name, F.text)
 async def reg_name(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     await state.update_data(name=msg.text)
-    await msg.answer("🎂  Yoshingiz nechida?", reply_markup=back_kb("reg_back_name"))
-    await state.set_state(RegState.age)
+    await ask_step(msg, state, REG_STEPS["age"])
 
 @dp.message(RegState.age, F.text)
 async def reg_age(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     await state.update_data(age=msg.text)
-    await msg.answer("📍  Qaysi viloyatdan?", reply_markup=back_kb("reg_back_age"))
-    await state.set_state(RegState.region)
+    await ask_step(msg, state, REG_STEPS["region"])
 
 @dp.message(RegState.region, F.text)
 async def reg_region(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     await state.update_data(region=msg.text)
-    await msg.answer("📞  Telefon raqamingizni yozing:", reply_markup=back_kb("reg_back_region"))
-    await state.set_state(RegState.phone)
+    await ask_step(msg, state, REG_STEPS["phone"])
 
 @dp.message(RegState.phone, F.text)
-async def reg_phone(msg: Message, state: FSMContext):
+async def reg_phone(msg: Message, state: FSMContext, user_record: UserRecord):
     await record_last_user_message(msg, state)
     data = await state.get_data()
     name = data["name"]
     age = data["age"]
     region = data["region"]
     phone = msg.text
-    status = register_user(msg.from_user.id, name, age, region, phone)
+    status = await db.register_user(msg.from_user.id, name, age, region, phone)
     await state.clear()
     await msg.answer(
         f"🎉  Tabriklaymiz! Ro'yxatdan o'tdingiz.\n"
         f"📋 Sizning tartib raqamingiz: **{status}**\n\n"
         "? Endi xizmatlardan to'liq foydalanishingiz mumkin.",
         parse_mode="Markdown",
-        reply_markup=menu_kb(msg.from_user.id == ADMIN_ID)
+        reply_markup=menu_kb(user_record.is_admin)
     )
     # Ma'lumotlarni @xolboyevv77 ga yuborish
-    await bot.send_message(
-        INFO_ADMIN_ID,
-        f"🆕 Yangi ro'yxatdan o'tgan:\n\n"
+    await notify_admin(
+        "send_message",
+        chat_id=INFO_ADMIN_ID,
+        text=f"🆕 Yangi ro'yxatdan o'tgan:\n\n"
         f"👤 Ism: {name}\n"
         f"🎂 Yosh: {age}\n"
         f"📍 Viloyat: {region}\n"
@@ -384,9 +2162,8 @@ async def reg_phone(msg: Message, state: FSMContext):
 # ====================================================
 # ===================== BILIM ULASH ==================
 # ====================================================
-@dp.message(F.text.contains("Bilim Ulash"))
-async def bilim_ulash_start(msg: Message, state: FSMContext):
-    if not is_registered(msg.from_user.id):
+async def bilim_ulash_start(msg: Message, state: FSMContext, user_record: UserRecord):
+    if not user_record.registered:
         await msg.answer(" Avval ro'yxatdan o'ting. /start bosing.", reply_markup=sub_kb())
         return
     await state.clear()
@@ -394,75 +2171,81 @@ async def bilim_ulash_start(msg: Message, state: FSMContext):
     await state.set_state(BilimUlashUserState.user_number)
 
 @dp.message(BilimUlashUserState.user_number, F.text)
-async def bilim_ulash_send(msg: Message, state: FSMContext):
+async def bilim_ulash_send(msg: Message, state: FSMContext, user_record: UserRecord):
     await record_last_user_message(msg, state)
     if not msg.text.isdigit():
         await msg.answer("Raqamni to'g'ri kiriting (faqat son):", reply_markup=back_kb("back_bilim_menu"))
         return
     num = int(msg.text)
-    text = get_bilim_message(num)
-    if text is None:
+    entry = db.bilim.get(num)
+    if entry is None:
         await msg.answer("Bu raqam bo'yicha ma'lumot topilmadi. Qayta kiriting:", reply_markup=back_kb("back_bilim_menu"))
         return
-    await msg.answer(text)
-    await msg.answer("Xizmatni tanlang 👇", reply_markup=menu_kb(msg.from_user.id == ADMIN_ID))
+    await send_bilim_entry(msg, entry)
+    await msg.answer("Xizmatni tanlang 👇", reply_markup=menu_kb(user_record.is_admin))
     await state.clear()
 
+BILIM_CAPTION_LIMIT = 1024
+
+async def send_bilim_entry(msg: Message, entry: BilimEntry):
+    """Yozuvni yuborish: fayli bo'lsa keshlangan file_id bilan (qayta yuklanmaydi)."""
+    if not entry.file_id:
+        await msg.answer(entry.text)
+        return
+    caption = entry.text if len(entry.text) <= BILIM_CAPTION_LIMIT else None
+    send = msg.answer_photo if entry.file_type == "photo" else msg.answer_document
+    await send(entry.file_id, caption=caption or None)
+    if caption is None:
+        await msg.answer(entry.text)
+
 @dp.callback_query(F.data == "back_bilim_menu")
-async def back_bilim_menu(call: CallbackQuery, state: FSMContext):
+async def back_bilim_menu(call: CallbackQuery, state: FSMContext, user_record: UserRecord):
     await delete_last_user_message(state)
     await state.clear()
     try:
         await call.message.delete()
     except Exception:
         pass
-    await call.message.answer("Xizmatni tanlang 👇", reply_markup=menu_kb(call.from_user.id == ADMIN_ID))
+    await call.message.answer("Xizmatni tanlang 👇", reply_markup=menu_kb(user_record.is_admin))
     await call.answer()
 
 # ===================== SLAYD =========================
 # ====================================================
-@dp.message(F.text.contains("Slayd buyurtma"))
-async def slide_start(msg: Message, state: FSMContext):
-    if not is_registered(msg.from_user.id):
+async def slide_start(msg: Message, state: FSMContext, user_record: UserRecord):
+    if not user_record.registered:
         await msg.answer(" Avval ro'yxatdan o'ting. /start bosing.", reply_markup=sub_kb())
         return
-    await msg.answer("📌  Slayd mavzusini yozing:", reply_markup=back_kb("back_to_menu"))
-    await state.set_state(SlideState.topic)
+    await ask_step(msg, state, SLIDE_STEPS["topic"])
 
 @dp.message(SlideState.topic, F.text)
 async def slide_topic(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     await state.update_data(topic=msg.text)
-    await msg.answer("📄  Necha varaq bo'lsin?", reply_markup=back_kb("back_slide_topic"))
-    await state.set_state(SlideState.pages)
+    await ask_step(msg, state, SLIDE_STEPS["pages"])
 
 @dp.message(SlideState.pages, F.text)
 async def slide_pages(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     await state.update_data(pages=msg.text)
-    await msg.answer("🎨  Qaysi ranglar ko'p bo'lsin?", reply_markup=back_kb("back_slide_pages"))
-    await state.set_state(SlideState.colors)
+    await ask_step(msg, state, SLIDE_STEPS["colors"])
 
 @dp.message(SlideState.colors, F.text)
 async def slide_colors(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     await state.update_data(colors=msg.text)
-    await msg.answer("📝  Matn qanchalik ko'p bo'lsin? (kam / o'rtacha / ko'p)", reply_markup=back_kb("back_slide_colors"))
-    await state.set_state(SlideState.text_amount)
+    await ask_step(msg, state, SLIDE_STEPS["text"])
 
 @dp.message(SlideState.text_amount, F.text)
 async def slide_text(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     await state.update_data(text_amount=msg.text)
-    await msg.answer("⏰ ? Qancha vaqtda tayyor bo'lsin? (minimal 2 soat)", reply_markup=back_kb("back_slide_text"))
-    await state.set_state(SlideState.deadline)
+    await ask_step(msg, state, SLIDE_STEPS["deadline"])
 
 @dp.message(SlideState.deadline, F.text)
 async def slide_deadline(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     await state.update_data(deadline=msg.text)
-    await msg.answer("📂  Qaysi formatda bo'lsin? (pdf / ppt / word / boshqasi)", reply_markup=back_kb("back_slide_deadline"))
-    await state.set_state(SlideState.format)
+    await ask_step(msg, state, SLIDE_STEPS["format"])
 
 @dp.message(SlideState.format, F.text)
 async def slide_format(msg: Message, state: FSMContext):
@@ -474,42 +2257,47 @@ async def slide_format(msg: Message, state: FSMContext):
         f"💳  Karta: {CARD_NUMBER}\n\n"
         "⚠️  To'lov qilganingizdan keyin chekini yuboring.\n"
         "❌ ? Cheksiz to'lov qabul qilinmaydi.",
-        reply_markup=back_kb("back_slide_format")
+        reply_markup=back_kb(SlideBack(step="format").pack())
     )
     await state.set_state(SlideState.payment)
 
 @dp.message(SlideState.payment, F.photo)
-async def slide_payment_photo(msg: Message, state: FSMContext):
+async def slide_payment_photo(msg: Message, state: FSMContext, user_record: UserRecord):
     await record_last_user_message(msg, state)
-    await slide_payment_any(msg, state, msg.photo[-1].file_id)
+    await slide_payment_any(msg, state, user_record, msg.photo[-1].file_id)
 
 @dp.message(SlideState.payment, F.document)
-async def slide_payment_doc(msg: Message, state: FSMContext):
+async def slide_payment_doc(msg: Message, state: FSMContext, user_record: UserRecord):
     await record_last_user_message(msg, state)
-    await slide_payment_any(msg, state, None, msg.document.file_id)
+    await slide_payment_any(msg, state, user_record, None, msg.document.file_id)
 
 @dp.message(SlideState.payment)
 async def slide_payment_other(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     await msg.answer(" Chekni rasm yoki hujjat ko'rinishida yuboring.")
 
-async def slide_payment_any(msg: Message, state: FSMContext, photo_id=None, doc_id=None):
+async def slide_payment_any(msg: Message, state: FSMContext, user_record: UserRecord, photo_id=None, doc_id=None):
     data = await state.get_data()
-    status = get_user_status(msg.from_user.id)
+    status = user_record.status
 
     status_msg = await msg.answer(
         "⏳ ? Admin tekshirmoqda. Ish boshlanganda sizga xabar beramiz."
     )
 
+    fields = {k: data.get(k) for k in ("topic", "pages", "colors", "text_amount", "deadline", "format")}
+    order_id = await orders.create(
+        msg.from_user.id, status_msg.message_id, "slide", fields, data.get("price"), *receipt_of(photo_id, doc_id)
+    )
+
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="➕", callback_data=f"ok_slide_{msg.from_user.id}_{status_msg.message_id}"),
-            InlineKeyboardButton(text="➖", callback_data=f"no_slide_{msg.from_user.id}_{status_msg.message_id}"),
+            InlineKeyboardButton(text="➕", callback_data=OrderAction(action="ok", order_id=order_id).pack()),
+            InlineKeyboardButton(text="➖", callback_data=OrderAction(action="no", order_id=order_id).pack()),
         ]
     ])
 
     text = (
-        f"🆕 SLAYD BUYURTMA | 📋 #{status}\n\n"
+        f"🆕 SLAYD BUYURTMA #{order_id} | 📋 #{status}\n\n"
         f"👤 @{msg.from_user.username or msg.from_user.id}\n"
         f"📌 Mavzu: {data['topic']}\n"
         f"📄 Varaq: {data['pages']}\n"
@@ -521,82 +2309,36 @@ async def slide_payment_any(msg: Message, state: FSMContext, photo_id=None, doc_
     )
 
     if photo_id:
-        await bot.send_photo(ADMIN_ID, photo_id, caption=text, reply_markup=kb)
+        await notify_admin("send_photo", photo=photo_id, caption=text, reply_markup=kb)
     elif doc_id:
-        await bot.send_document(ADMIN_ID, doc_id, caption=text, reply_markup=kb)
+        await notify_admin("send_document", document=doc_id, caption=text, reply_markup=kb)
     else:
-        await bot.send_message(ADMIN_ID, text + "\n\n⚠️ Chek rasm yoki hujjat ko'rinishida yuborilmadi", reply_markup=kb)
+        await notify_admin("send_message", text=text + "\n\n⚠️ Chek rasm yoki hujjat ko'rinishida yuborilmadi", reply_markup=kb)
 
     await state.clear()
 
 # ===================== USER BACK HANDLERS (Slayd) =====================
-@dp.callback_query(F.data.startswith("back_slide_"))
-async def back_slide_handlers(call: CallbackQuery, state: FSMContext):
-    await delete_last_user_message(state)
-    data = call.data
-    await call.answer()
-    
-    if data == "back_slide_topic":
-        await state.set_state(SlideState.topic)
-        try:
-            await call.message.delete()
-        except Exception:
-            pass
-        await call.message.answer("📌  Slayd mavzusini yozing:", reply_markup=back_kb("back_to_menu"))
-    
-    elif data == "back_slide_pages":
-        await state.set_state(SlideState.pages)
-        try:
-            await call.message.delete()
-        except Exception:
-            pass
-        await call.message.answer("📄  Necha varaq bo'lsin?", reply_markup=back_kb("back_slide_topic"))
-        
-    elif data == "back_slide_colors":
-        await state.set_state(SlideState.colors)
-        try:
-            await call.message.delete()
-        except Exception:
-            pass
-        await call.message.answer("🎨  Qaysi ranglar ko'p bo'lsin?", reply_markup=back_kb("back_slide_pages"))
-        
-    elif data == "back_slide_text":
-        await state.set_state(SlideState.text_amount)
-        try:
-            await call.message.delete()
-        except Exception:
-            pass
-        await call.message.answer("📝  Matn qanchalik ko'p bo'lsin? (kam / o'rtacha / ko'p)", reply_markup=back_kb("back_slide_colors"))
-        
-    elif data == "back_slide_deadline":
-        await state.set_state(SlideState.deadline)
-        try:
-            await call.message.delete()
-        except Exception:
-            pass
-        await call.message.answer("⏰ ? Qancha vaqtda tayyor bo'lsin? (minimal 2 soat)", reply_markup=back_kb("back_slide_text"))
-    
-    elif data == "back_slide_format":
-        await state.set_state(SlideState.format)
-        try:
-            await call.message.delete()
-        except Exception:
-            pass
-        await call.message.answer("📂  Qaysi formatda bo'lsin? (pdf / ppt / word / boshqasi)", reply_markup=back_kb("back_slide_deadline"))
+@dp.callback_query(SlideBack.filter())
+@dp.callback_query(LegacyStep(SlideBack, "back_slide_"))
+async def back_slide_handlers(call: CallbackQuery, state: FSMContext, callback_data: SlideBack):
+    step = SLIDE_STEPS.get(callback_data.step)
+    if step is None:
+        await call.answer()
+        return
+    await back_to_step(call, state, step)
 
 @dp.callback_query(F.data == "back_to_menu")
-async def back_to_main_menu(call: CallbackQuery, state: FSMContext):
+async def back_to_main_menu(call: CallbackQuery, state: FSMContext, user_record: UserRecord):
     await delete_last_user_message(state)
     await state.clear()
     try:
         await call.message.delete()
     except Exception:
         pass
-    await call.message.answer("Xizmatni tanlang 👇", reply_markup=menu_kb(call.from_user.id == ADMIN_ID))
+    await call.message.answer("Xizmatni tanlang 👇", reply_markup=menu_kb(user_record.is_admin))
 
 # ===================== ADMIN CONTACT =====================
-@priority_router.message(F.text.contains("Admin bilan bog'lanish") | F.text.contains("Admin bilan boglanish"))
-async def admin_contact(msg: Message, state: FSMContext):
+async def admin_contact(msg: Message, state: FSMContext, user_record: UserRecord):
     await delete_last_user_message(state)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=" Adminga yozish", url=f"tg://user?id={INFO_ADMIN_ID}")]
@@ -607,8 +2349,7 @@ async def admin_contact(msg: Message, state: FSMContext):
     )
 
 # ===================== BOT YARATISH =====================
-@priority_router.message(F.text.contains("Bot yaratib berish"))
-async def bot_create_contact(msg: Message, state: FSMContext):
+async def bot_create_contact(msg: Message, state: FSMContext, user_record: UserRecord):
     await delete_last_user_message(state)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=" Adminga yozish", url=f"tg://user?id={INFO_ADMIN_ID}")]
@@ -623,84 +2364,37 @@ async def bot_create_contact(msg: Message, state: FSMContext):
 # ====================================================
 # ===================== AI VIDEO =====================
 # ====================================================
-@dp.message(F.text.contains("AI Video"))
-async def ai_video(msg: Message, state: FSMContext):
-    if not is_registered(msg.from_user.id):
+async def ai_video(msg: Message, state: FSMContext, user_record: UserRecord):
+    if not user_record.registered:
         await msg.answer("🔐 Avval ro‘yxatdan o‘ting. /start bosing.", reply_markup=sub_kb())
         return
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🖼️ Rasmni video qilish", callback_data="ai_img_to_video")],
-        [InlineKeyboardButton(text="🎨 Rasm yaratish", callback_data="ai_image_gen")],
-        [InlineKeyboardButton(text="🎬 Men hohlagan video", callback_data="ai_custom_video")],
-    ])
     await state.set_state(VideoState.menu)
     await msg.answer(
         "🎬 AI video xizmati.\n📌 Max 10 soniya.\n\n"
         "👇 Xizmat turini tanlang:",
-        reply_markup=kb
+        reply_markup=ai_menu_kb()
     )
 
 @dp.callback_query(F.data == "ai_img_to_video")
-async def ai_img_to_video(call: CallbackQuery, state: FSMContext):
-    await delete_last_user_message(state)
-    await state.clear()
-    await state.set_state(VideoState.img_to_video_image)
-    try:
-        await call.message.delete()
-    except Exception:
-        pass
-    await call.message.answer("? Video yaratmoqchi bo'lgan rasmni yuboring:", reply_markup=back_kb("back_ai_menu"))
-    await call.answer()
-
 @dp.callback_query(F.data == "ai_image_gen")
-async def ai_image_gen(call: CallbackQuery, state: FSMContext):
-    await delete_last_user_message(state)
-    await state.clear()
-    await state.set_state(VideoState.image_gen_prompt)
-    try:
-        await call.message.delete()
-    except Exception:
-        pass
-    await call.message.answer(
-        " Yaratmoqchi bo'lgan rasmingizni shunchaki tasvirlab bering."
-        "Misol uchun: bir yosh yigit korzinka supermarketi yonida qo'lida kamera bilan turibdi va futbolkasida instagram akkaunti nomi yozilgan..."
-        "Shu kabi hohlagan narsangizni yozing, sifatli rasm tayyorlash mendan :)",
-        reply_markup=back_kb("back_ai_menu")
-    )
-    await call.answer()
-
 @dp.callback_query(F.data == "ai_custom_video")
-async def ai_custom_video(call: CallbackQuery, state: FSMContext):
+async def ai_choose_service(call: CallbackQuery, state: FSMContext):
     await delete_last_user_message(state)
     await state.clear()
-    await state.set_state(VideoState.custom_prompt)
-    try:
-        await call.message.delete()
-    except Exception:
-        pass
-    await call.message.answer(
-        "  Video haqida xohishingizni yozing."
-"  Qisqa va tushunarli yozing.",
-        reply_markup=back_kb("back_ai_menu")
-    )
-    await call.answer()
+    step = {"ai_img_to_video": "image", "ai_image_gen": "imagegen_prompt", "ai_custom_video": "custom"}[call.data]
+    await back_to_step(call, state, VIDEO_STEPS[step])
 
 # -------- Rasmni video qilish --------
 @dp.message(VideoState.img_to_video_image, F.photo)
 async def ai_img_to_video_image(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     await state.update_data(image_file_id=msg.photo[-1].file_id)
-    await msg.answer(
-        " Sizga qanaqa video kerak? Shunchaki yozing."
-        "Misol uchun: rasmdagi odam nimadir deb gapirsin.",
-        reply_markup=back_kb("back_ai_image")
-    )
-    await state.set_state(VideoState.img_to_video_prompt)
+    await ask_step(msg, state, VIDEO_STEPS["prompt"])
 
 @dp.message(VideoState.img_to_video_image)
 async def ai_img_to_video_image_other(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
-    await msg.answer("Iltimos, rasm yuboring.", reply_markup=back_kb("back_ai_menu"))
+    await msg.answer("Iltimos, rasm yuboring.", reply_markup=VIDEO_STEPS["image"].markup)
 
 @dp.message(VideoState.img_to_video_prompt, F.text)
 async def ai_img_to_video_prompt(msg: Message, state: FSMContext):
@@ -713,7 +2407,7 @@ async def ai_img_to_video_prompt(msg: Message, state: FSMContext):
         f" Karta raqam: {CARD_NUMBER}"
         "Shu karta raqmga to'lov qilib chekini yuboring."
         "Eslatib o'tamiz, cheksiz to'lov qabul qilinmaydi!",
-        reply_markup=back_kb("back_ai_prompt")
+        reply_markup=back_kb(VideoBack(step="prompt").pack())
     )
     await state.set_state(VideoState.img_to_video_payment)
 
@@ -722,11 +2416,7 @@ async def ai_img_to_video_prompt(msg: Message, state: FSMContext):
 async def ai_image_gen_prompt(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     await state.update_data(prompt=msg.text)
-    await msg.answer(
-        "Rasm qanaqa formatda bo'lsin? (Instagram stories / kvadrat / YouTube format va hokazo)",
-        reply_markup=back_kb("back_ai_imagegen_prompt")
-    )
-    await state.set_state(VideoState.image_gen_format)
+    await ask_step(msg, state, VIDEO_STEPS["imagegen_format"])
 
 @dp.message(VideoState.image_gen_format, F.text)
 async def ai_image_gen_format(msg: Message, state: FSMContext):
@@ -739,7 +2429,7 @@ async def ai_image_gen_format(msg: Message, state: FSMContext):
         f" Karta raqam: {CARD_NUMBER}"
         "Shu karta raqamga to'lov qilib chekini yuboring."
         "Eslatib o'tamiz, cheksiz to'lov qabul qilinmaydi!",
-        reply_markup=back_kb("back_ai_imagegen_format")
+        reply_markup=back_kb(VideoBack(step="imagegen_format").pack())
     )
     await state.set_state(VideoState.image_gen_payment)
 
@@ -755,7 +2445,7 @@ async def ai_custom_prompt(msg: Message, state: FSMContext):
         f" Karta raqam: {CARD_NUMBER}"
         "Shu karta raqamga to'lov qilib chekini yuboring."
         "Eslatib o'tamiz, cheksiz to'lov qabul qilinmaydi!",
-        reply_markup=back_kb("back_ai_custom")
+        reply_markup=back_kb(VideoBack(step="custom").pack())
     )
     await state.set_state(VideoState.custom_payment)
 
@@ -763,16 +2453,16 @@ async def ai_custom_prompt(msg: Message, state: FSMContext):
 @dp.message(VideoState.img_to_video_payment, F.photo)
 @dp.message(VideoState.image_gen_payment, F.photo)
 @dp.message(VideoState.custom_payment, F.photo)
-async def ai_payment_photo(msg: Message, state: FSMContext):
+async def ai_payment_photo(msg: Message, state: FSMContext, user_record: UserRecord):
     await record_last_user_message(msg, state)
-    await ai_payment_any(msg, state, msg.photo[-1].file_id)
+    await ai_payment_any(msg, state, user_record, msg.photo[-1].file_id)
 
 @dp.message(VideoState.img_to_video_payment, F.document)
 @dp.message(VideoState.image_gen_payment, F.document)
 @dp.message(VideoState.custom_payment, F.document)
-async def ai_payment_doc(msg: Message, state: FSMContext):
+async def ai_payment_doc(msg: Message, state: FSMContext, user_record: UserRecord):
     await record_last_user_message(msg, state)
-    await ai_payment_any(msg, state, None, msg.document.file_id)
+    await ai_payment_any(msg, state, user_record, None, msg.document.file_id)
 
 @dp.message(VideoState.img_to_video_payment)
 @dp.message(VideoState.image_gen_payment)
@@ -781,25 +2471,30 @@ async def ai_payment_other(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     await msg.answer(" Chekni rasm yoki hujjat ko'rinishida yuboring.")
 
-async def ai_payment_any(msg: Message, state: FSMContext, photo_id=None, doc_id=None):
+async def ai_payment_any(msg: Message, state: FSMContext, user_record: UserRecord, photo_id=None, doc_id=None):
     data = await state.get_data()
-    status = get_user_status(msg.from_user.id)
+    status = user_record.status
     kind = data.get("kind")
 
     status_msg = await msg.answer(
         "? ? Admin tekshirmoqda. Ish boshlanganda sizga xabar beramiz."
     )
 
+    fields = {k: data.get(k) for k in ("kind", "prompt", "format", "image_file_id")}
+    order_id = await orders.create(
+        msg.from_user.id, status_msg.message_id, "video", fields, data.get("price"), *receipt_of(photo_id, doc_id)
+    )
+
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="", callback_data=f"ok_video_{msg.from_user.id}_{status_msg.message_id}"),
-            InlineKeyboardButton(text="", callback_data=f"no_video_{msg.from_user.id}_{status_msg.message_id}"),
+            InlineKeyboardButton(text="", callback_data=OrderAction(action="ok", order_id=order_id).pack()),
+            InlineKeyboardButton(text="", callback_data=OrderAction(action="no", order_id=order_id).pack()),
         ]
     ])
 
     if kind == "img_to_video":
         text = (
-            f" AI VIDEO BUYURTMA |  #{status}"
+            f" AI VIDEO BUYURTMA #{order_id} |  #{status}"
             f" @{msg.from_user.username or msg.from_user.id}"
             "? Tur: Rasmni video qilish"
             f" Matn: {data.get('prompt')}"
@@ -807,7 +2502,7 @@ async def ai_payment_any(msg: Message, state: FSMContext, photo_id=None, doc_id=
         )
     elif kind == "image_gen":
         text = (
-            f" AI VIDEO BUYURTMA |  #{status}"
+            f" AI VIDEO BUYURTMA #{order_id} |  #{status}"
             f" @{msg.from_user.username or msg.from_user.id}"
             " Tur: Rasm yaratish"
             f" Tavsif: {data.get('prompt')}"
@@ -816,149 +2511,112 @@ async def ai_payment_any(msg: Message, state: FSMContext, photo_id=None, doc_id=
         )
     else:
         text = (
-            f" AI VIDEO BUYURTMA |  #{status}"
+            f" AI VIDEO BUYURTMA #{order_id} |  #{status}"
             f" @{msg.from_user.username or msg.from_user.id}"
             " Tur: Men hohlagan video"
             f" Matn: {data.get('prompt')}"
             f" {data.get('price')} so'm"
         )
 
+    source = None  # manba rasm chekdan keyin keladi
+    if kind == "img_to_video" and data.get("image_file_id"):
+        source = {"method": "send_photo", "photo": data.get("image_file_id"), "caption": "? Manba rasm"}
+
     if photo_id:
-        await bot.send_photo(ADMIN_ID, photo_id, caption=text, reply_markup=kb)
+        await notify_admin("send_photo", photo=photo_id, caption=text, reply_markup=kb, then=source)
     elif doc_id:
-        await bot.send_document(ADMIN_ID, doc_id, caption=text, reply_markup=kb)
+        await notify_admin("send_document", document=doc_id, caption=text, reply_markup=kb, then=source)
     else:
-        await bot.send_message(ADMIN_ID, text + " Chek rasm yoki hujjat ko'rinishida yuborilmadi", reply_markup=kb)
-
-    if kind == "img_to_video" and data.get("image_file_id"):
-        try:
-            await bot.send_photo(ADMIN_ID, data.get("image_file_id"), caption="? Manba rasm")
-        except Exception:
-            pass
+        await notify_admin("send_message", text=text + " Chek rasm yoki hujjat ko'rinishida yuborilmadi",
+                           reply_markup=kb, then=source)
 
     await state.clear()
 
 # ===================== USER BACK HANDLERS (Video) =====================
-@dp.callback_query(F.data == "back_ai_menu")
-async def back_ai_menu(call: CallbackQuery, state: FSMContext):
-    await delete_last_user_message(state)
-    await state.set_state(VideoState.menu)
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="? Rasmni video qilish", callback_data="ai_img_to_video")],
-        [InlineKeyboardButton(text=" Rasm yaratish", callback_data="ai_image_gen")],
-        [InlineKeyboardButton(text=" Men hohlagan video", callback_data="ai_custom_video")],
-    ])
-    try:
-        await call.message.delete()
-    except Exception:
-        pass
-    await call.message.answer(" Xizmat turini tanlang:", reply_markup=kb)
-    await call.answer()
+@dp.callback_query(VideoBack.filter())
+@dp.callback_query(LegacyStep(VideoBack, "back_ai_"))
+async def back_ai_handlers(call: CallbackQuery, state: FSMContext, callback_data: VideoBack):
+    step = VIDEO_STEPS.get(callback_data.step)
+    if step is None:
+        await call.answer()
+        return
+    await back_to_step(call, state, step)
 
-@dp.callback_query(F.data == "back_ai_image")
-async def back_ai_image(call: CallbackQuery, state: FSMContext):
-    await delete_last_user_message(state)
-    await state.set_state(VideoState.img_to_video_image)
-    try:
-        await call.message.delete()
-    except Exception:
-        pass
-    await call.message.answer("? Video yaratmoqchi bo'lgan rasmni yuboring:", reply_markup=back_kb("back_ai_menu"))
-    await call.answer()
+# ===================== ADMIN CALLBACK (➕/➖) =====================
+ORDER_STATUS_LABELS = {"pending": "kutilmoqda", "approved": "tasdiqlangan", "declined": "rad etilgan"}
 
-@dp.callback_query(F.data == "back_ai_prompt")
-async def back_ai_prompt(call: CallbackQuery, state: FSMContext):
-    await delete_last_user_message(state)
-    await state.set_state(VideoState.img_to_video_prompt)
-    try:
-        await call.message.delete()
-    except Exception:
-        pass
-    await call.message.answer(
-        " Sizga qanaqa video kerak? Shunchaki yozing."
-        "Misol uchun: rasmdagi odam nimadir deb gapirsin.",
-        reply_markup=back_kb("back_ai_image")
-    )
-    await call.answer()
+def order_approved_text(kind: str) -> str:
+    if kind == "slide":
+        return "✅  To'lovingiz qabul qilindi.\n📝 Slayd tayyorlashni boshladik.\n📂 Tayyor bo'lganda slayd faylini yuboraman."
+    return "✅  To'lovingiz qabul qilindi.\n🎬 Videoni tayyorlashni boshladik.\n📂 Tayyor bo'lganda video faylini yuboraman."
 
-@dp.callback_query(F.data == "back_ai_imagegen_prompt")
-async def back_ai_imagegen_prompt(call: CallbackQuery, state: FSMContext):
-    await delete_last_user_message(state)
-    await state.set_state(VideoState.image_gen_prompt)
-    try:
-        await call.message.delete()
-    except Exception:
-        pass
-    await call.message.answer(
-        " Yaratmoqchi bo'lgan rasmingizni shunchaki tasvirlab bering."
-        "Misol uchun: bir yosh yigit korzinka supermarketi yonida qo'lida kamera bilan turibdi va futbolkasida instagram akkaunti nomi yozilgan..."
-        "Shu kabi hohlagan narsangizni yozing, sifatli rasm tayyorlash mendan :)",
-        reply_markup=back_kb("back_ai_menu")
-    )
-    await call.answer()
+ORDER_DECLINED_TEXT = (
+    "❌  To'lov qabul qilinmadi.\n"
+    "Soxta chek yoki boshqa muammo yuz bergan bo'lishi mumkin (afsuski slayd tayyorlashni boshlay olmayman).\n\n"
+    "Agar sizda shikoyat bo'lsa, adminga murojaat qilishingiz mumkin."
+)
 
-@dp.callback_query(F.data == "back_ai_imagegen_format")
-async def back_ai_imagegen_format(call: CallbackQuery, state: FSMContext):
-    await delete_last_user_message(state)
-    await state.set_state(VideoState.image_gen_format)
+async def notify_order_decision(order: dict, approved: bool):
+    """User'dagi "Admin tekshirmoqda" xabarini natija bilan almashtirish."""
+    if approved:
+        await bot.edit_message_text(order_approved_text(order["kind"]), chat_id=order["user_id"], message_id=order["status_msg_id"])
+    else:
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=" Adminga yozish", url=f"tg://user?id={ADMIN_ID}")]
+        ])
+        await bot.edit_message_text(ORDER_DECLINED_TEXT, chat_id=order["user_id"], message_id=order["status_msg_id"], reply_markup=kb)
+
+@jobs.handler("order_decision")
+async def job_order_decision(user_id: int, order_kind: str, status_msg_id: int, approved: bool):
+    order = {"user_id": user_id, "kind": order_kind, "status_msg_id": status_msg_id}
     try:
-        await call.message.delete()
-    except Exception:
-        pass
-    await call.message.answer(
-        "Rasm qanaqa formatda bo'lsin? (Instagram stories / kvadrat / YouTube format va hokazo)",
-        reply_markup=back_kb("back_ai_imagegen_prompt")
-    )
-    await call.answer()
+        with send_priority(PRIORITY_USER):
+            await notify_order_decision(order, approved)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):  # oldingi urinish aslida yetib borgan
+            raise
+
+def order_decision_job(order: dict, approved: bool) -> dict:
+    return {"user_id": order["user_id"], "order_kind": order["kind"], "status_msg_id": order["status_msg_id"],
+            "approved": approved}
+
+ORDER_ACTIONS = {"ok": True, "no": False}  # tugma -> tasdiqlandimi
+
+async def announce_decision(call: CallbackQuery, order: dict, approved: bool):
+    """Holat allaqachon yozilgan — userga xabar jobs orqali (xato bo'lsa qayta uriniladi)."""
+    await jobs.enqueue("order_decision", **order_decision_job(order, approved))
+    await call.answer("Tasdiqlandi" if approved else "Rad etildi")
+
+async def decide_order(call: CallbackQuery, order_id: int, approved: bool):
+    order = await orders.transition(order_id, "approved" if approved else "declined")
+    if order is None:
+        current = await orders.get(order_id)
+        label = ORDER_STATUS_LABELS.get(current["status"], current["status"]) if current else "topilmadi"
+        await call.answer(f"Buyurtma #{order_id}: {label}", show_alert=True)
+        return
+    await announce_decision(call, order, approved)
 
-@dp.callback_query(F.data == "back_ai_custom")
-async def back_ai_custom(call: CallbackQuery, state: FSMContext):
-    await delete_last_user_message(state)
-    await state.set_state(VideoState.custom_prompt)
-    try:
-        await call.message.delete()
-    except Exception:
-        pass
-    await call.message.answer(
-        "  Video haqida xohishingizni yozing."
-        "  Qisqa va tushunarli yozing.",
-        reply_markup=back_kb("back_ai_menu")
-    )
-    await call.answer()
+@dp.callback_query(OrderAction.filter(F.action.in_(ORDER_ACTIONS)))
+async def order_action(call: CallbackQuery, callback_data: OrderAction):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    await decide_order(call, callback_data.order_id, ORDER_ACTIONS[callback_data.action])
 
-# ===================== ADMIN CALLBACK (➕/➖) =====================
-@dp.callback_query(F.data.startswith("ok_"))
-async def approve(call: CallbackQuery):
+# Oldin yuborilgan tugmalar: {ok|no}_{order_id} va {ok|no}_{kind}_{user_id}_{msg_id} (buyurtma yozuvisiz)
+@dp.callback_query(F.data.regexp(r"^(ok|no)_(\d+|[a-z]+_\d+_\d+)$"))
+async def order_action_legacy(call: CallbackQuery):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
     parts = call.data.split("_")
-    _, kind, user_id_str, msg_id_str = parts
-    user_id = int(user_id_str)
-    status_message_id = int(msg_id_str)
-
-    if kind == "slide":
-        text = "✅  To'lovingiz qabul qilindi.\n📝 Slayd tayyorlashni boshladik.\n📂 Tayyor bo'lganda slayd faylini yuboraman."
+    approved = ORDER_ACTIONS[parts[0]]
+    if len(parts) == 4:
+        _, kind, user_id_str, msg_id_str = parts
+        order = {"kind": kind, "user_id": int(user_id_str), "status_msg_id": int(msg_id_str)}
+        await announce_decision(call, order, approved)
     else:
-        text = "✅  To'lovingiz qabul qilindi.\n🎬 Videoni tayyorlashni boshladik.\n📂 Tayyor bo'lganda video faylini yuboraman."
-
-    await bot.edit_message_text(text, chat_id=user_id, message_id=status_message_id)
-    await call.answer("Tasdiqlandi")
-
-@dp.callback_query(F.data.startswith("no_"))
-async def decline(call: CallbackQuery):
-    parts = call.data.split("_")
-    _, kind, user_id_str, msg_id_str = parts
-    user_id = int(user_id_str)
-    status_message_id = int(msg_id_str)
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=" Adminga yozish", url=f"tg://user?id={ADMIN_ID}")]
-    ])
-    text = (
-        "❌  To'lov qabul qilinmadi.\n"
-        "Soxta chek yoki boshqa muammo yuz bergan bo'lishi mumkin (afsuski slayd tayyorlashni boshlay olmayman).\n\n"
-        "Agar sizda shikoyat bo'lsa, adminga murojaat qilishingiz mumkin."
-    )
-    await bot.edit_message_text(text, chat_id=user_id, message_id=status_message_id, reply_markup=kb)
-    await call.answer("Rad etildi")
+        await decide_order(call, int(parts[1]), approved)
 
 # ===================== ADMIN PANEL (callback'lar) =====================
 @dp.callback_query(F.data == "admin_numbers")
@@ -1014,9 +2672,12 @@ async def admin_numbers_add_number(msg: Message, state: FSMContext):
         return
     await state.update_data(add_number=int(msg.text))
     await state.set_state(BilimUlashAdminState.add_message)
-    await msg.answer("Raqamga ulanadigan habarni kiriting:", reply_markup=back_kb("admin_numbers_menu"))
+    await msg.answer(
+        "Raqamga ulanadigan habarni kiriting (matn, yoki izohli foto/hujjat):",
+        reply_markup=back_kb("admin_numbers_menu"),
+    )
 
-@dp.message(BilimUlashAdminState.add_message, F.text)
+@dp.message(BilimUlashAdminState.add_message, F.text | F.photo | F.document)
 async def admin_numbers_add_message(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
     if msg.from_user.id != ADMIN_ID:
@@ -1027,10 +2688,181 @@ async def admin_numbers_add_message(msg: Message, state: FSMContext):
         await msg.answer("Avval raqamni kiriting.", reply_markup=back_kb("admin_numbers_menu"))
         await state.set_state(BilimUlashAdminState.add_number)
         return
-    add_bilim_number(number, msg.text)
+    file_id, file_type = receipt_of(msg.photo[-1].file_id if msg.photo else None,
+                                    msg.document.file_id if msg.document else None)
+    await db.add_bilim_number(number, msg.text or msg.caption or "", file_id, file_type)
     await msg.answer("? Raqamingiz muvaffaqiyatli qo'shildi!", reply_markup=admin_numbers_kb())
     await state.clear()
 
+# ----- Import / eksport -----
+# Import: CSV (raqam,matn[,file_id,file_type]) yoki JSON ({"12": "matn" | {"text", "file_id", "file_type"}}
+# yoki [{"number": 12, "text": ...}, ...]). Hujjat avval to'liq tekshiriladi, keyin bitta tranzaksiyada yoziladi.
+BILIM_IMPORT_MAX_BYTES = 20 * 1024 * 1024  # Bot API getFile chegarasi
+BILIM_FILE_TYPES = ("photo", "document")
+
+BILIM_IMPORT_HEADERS = ("number", "raqam", "nomer", "num", "id", "#")
+
+def parse_bilim_import(raw: bytes, filename: str) -> tuple[list[tuple[int, BilimEntry]], list[str]]:
+    """Fayl to'liq tekshiriladi: xato bo'lgan har bir qator errors ga tushadi (qator raqami bilan)."""
+    text = raw.decode("utf-8-sig")
+    errors = []
+    if filename.lower().endswith(".json"):
+        doc = json.loads(text)
+        if isinstance(doc, dict):
+            rows = [(line, k, v) for line, (k, v) in enumerate(doc.items(), 1)]
+        elif isinstance(doc, list):
+            rows = [(line, r.get("number") if isinstance(r, dict) else None, r) for line, r in enumerate(doc, 1)]
+        else:
+            raise ValueError("JSON obyekt yoki ro'yxat bo'lishi kerak")
+    else:
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        rows = []
+        reader = csv.reader(io.StringIO(text), dialect)
+        first = True
+        for row in reader:
+            if not row or not "".join(row).strip():
+                continue
+            if first and row[0].strip().lower() in BILIM_IMPORT_HEADERS:
+                first = False
+                continue  # sarlavha qatori — faqat birinchisi
+            first = False
+            file_id = row[2].strip() if len(row) > 2 else ""
+            file_type = row[3].strip() if len(row) > 3 else ""
+            # Qo'shtirnoqsiz vergulli matn ortiqcha ustunlarga bo'linadi — uni file_id deb olmaslik kerak
+            if len(row) > 4 or (file_id and not file_type):
+                errors.append(f"{reader.line_num}: ustunlar ortiqcha (vergulli matnni qo'shtirnoqqa oling "
+                              "yoki file_type ni ko'rsating)")
+                continue
+            rows.append((reader.line_num, row[0], {
+                "text": row[1] if len(row) > 1 else "",
+                "file_id": file_id or None,
+                "file_type": file_type or None,
+            }))
+    entries: dict[int, BilimEntry] = {}
+    for line, number, value in rows:
+        number = str(number).strip()
+        if not number.isdigit():
+            errors.append(f"{line}: raqam noto'g'ri ({number!r})")
+            continue
+        if isinstance(value, dict):
+            entry = BilimEntry(str(value.get("text") or ""), value.get("file_id") or None,
+                               value.get("file_type") or None)
+        elif isinstance(value, str):
+            entry = BilimEntry(value)
+        else:
+            errors.append(f"{line}: qiymat noto'g'ri")
+            continue
+        if entry.file_id and entry.file_type is None:
+            entry = BilimEntry(entry.text, entry.file_id, "document")  # faqat JSON: CSV da file_type majburiy
+        if entry.file_id and entry.file_type not in BILIM_FILE_TYPES:
+            errors.append(f"{line}: file_type photo yoki document bo'lishi kerak")
+        elif not entry.text and not entry.file_id:
+            errors.append(f"{line}: matn ham, fayl ham yo'q")
+        else:
+            entries[int(number)] = entry
+    return sorted(entries.items()), errors
+
+def write_bilim_export(path: str, items: list[tuple[int, BilimEntry]]):
+    """CSV qator-baqator faylga yoziladi (butun eksport xotirada bitta satr bo'lib turmaydi)."""
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["number", "text", "file_id", "file_type"])
+        for number, entry in items:
+            writer.writerow([number, entry.text, entry.file_id or "", entry.file_type or ""])
+
+@dp.callback_query(F.data == "admin_numbers_import")
+async def admin_numbers_import(call: CallbackQuery, state: FSMContext):
+    await delete_last_user_message(state)
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    await state.clear()
+    await state.set_state(BilimUlashAdminState.import_file)
+    try:
+        await call.message.delete()
+    except Exception:
+        pass
+    await call.message.answer(
+        "📥 CSV yoki JSON faylni yuboring.\n\n"
+        "CSV: raqam,matn[,file_id,file_type]\n"
+        "JSON: {\"12\": \"matn\"} yoki [{\"number\": 12, \"text\": \"...\", \"file_id\": \"...\", \"file_type\": \"photo\"}]\n\n"
+        "Mavjud raqamlar yangilanadi. Xato bo'lsa hech narsa yozilmaydi.",
+        reply_markup=back_kb("admin_numbers_menu"),
+    )
+    await call.answer()
+
+@dp.message(BilimUlashAdminState.import_file, F.document)
+async def admin_numbers_import_file(msg: Message, state: FSMContext):
+    await record_last_user_message(msg, state)
+    if msg.from_user.id != ADMIN_ID:
+        return
+    if (msg.document.file_size or 0) > BILIM_IMPORT_MAX_BYTES:
+        await msg.answer("Fayl juda katta (20 MB dan oshmasin).", reply_markup=back_kb("admin_numbers_menu"))
+        return
+    buf = await bot.download(msg.document)
+    try:
+        # CPU ishi — storage oqimini band qilmasin (u yerda faqat add_bilim_entries yoziladi)
+        entries, errors = await asyncio.to_thread(parse_bilim_import, buf.getvalue(), msg.document.file_name or "")
+    except (ValueError, csv.Error) as e:
+        await msg.answer(f"Faylni o'qib bo'lmadi: {e}", reply_markup=back_kb("admin_numbers_menu"))
+        return
+    if errors:
+        shown = "\n".join(errors[:10]) + (f"\n… yana {len(errors) - 10} ta" if len(errors) > 10 else "")
+        await msg.answer(f"❌ {len(errors)} ta xato, hech narsa yozilmadi:\n{shown}", reply_markup=back_kb("admin_numbers_menu"))
+        return
+    if not entries:
+        await msg.answer("Faylda yozuv topilmadi.", reply_markup=back_kb("admin_numbers_menu"))
+        return
+    count = await db.add_bilim_entries(entries)
+    await msg.answer(f"✅ {count} ta raqam import qilindi.", reply_markup=admin_numbers_kb())
+    await state.clear()
+
+@dp.callback_query(F.data == "admin_numbers_export")
+async def admin_numbers_export(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    await call.answer("Eksport tayyorlanmoqda...")
+    items = [(n, db.bilim.entries[n]) for n in db.bilim.numbers]
+    fd, path = tempfile.mkstemp(prefix="bilim_", suffix=".csv")
+    os.close(fd)
+    try:
+        await run_storage(write_bilim_export, path, items)
+        await call.message.answer_document(
+            FSInputFile(path, filename="bilim.csv"), caption=f"📤 {len(items)} ta raqam",
+        )
+    finally:
+        await run_storage(os.remove, path)
+
+# Raqamlar ro'yxati db.bilim indeksidan sahifalab ko'rsatiladi (bitta xabar 4096 belgidan oshmasin)
+BILIM_PAGE_SIZE = 20
+BILIM_PREVIEW_LEN = 50
+
+def render_bilim_page(after: int | None = None, before: int | None = None, at: int | None = None):
+    if at is not None:
+        items, has_prev, has_next = db.bilim.page_at(at, BILIM_PAGE_SIZE)
+    else:
+        items, has_prev, has_next = db.bilim.page(after, before, BILIM_PAGE_SIZE)
+    lines = [
+        f"{n} - {'📎 ' if e.file_id else ''}"
+        f"{e.text if len(e.text) <= BILIM_PREVIEW_LEN else e.text[:BILIM_PREVIEW_LEN] + '…'}".replace("\n", " ")
+        for n, e in items
+    ]
+    text = f"Mavjud raqamlar: {len(db.bilim)} ta\n" + ("\n".join(lines) if lines else "(bo'sh)")
+    text += "\n\nO'chirish uchun raqamni kiriting:"
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=BilimPage(dir="prev", anchor=items[0][0]).pack()))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=BilimPage(dir="next", anchor=items[-1][0]).pack()))
+    rows = [nav] if nav else []
+    rows.append([InlineKeyboardButton(text="🔎 Raqamga o'tish", callback_data="admin_numbers_jump")])
+    rows.append([InlineKeyboardButton(text="⬅️ Orqaga qaytish", callback_data="admin_numbers_menu")])
+    return text, InlineKeyboardMarkup(inline_keyboard=rows)
+
 @dp.callback_query(F.data == "admin_numbers_delete")
 async def admin_numbers_delete(call: CallbackQuery, state: FSMContext):
     await delete_last_user_message(state)
@@ -1038,17 +2870,52 @@ async def admin_numbers_delete(call: CallbackQuery, state: FSMContext):
         await call.answer()
         return
     await state.clear()
-    items = list_bilim_numbers()
-    lines = [f"{n} - {t}" for n, t in items]
-    text = "Mavjud raqamlar:\n" + ("\n".join(lines) if lines else "(bo'sh)")
+    text, kb = render_bilim_page()
     try:
         await call.message.delete()
     except Exception:
         pass
-    await call.message.answer(text + "\n\nO'chirish uchun raqamni kiriting:", reply_markup=back_kb("admin_numbers_menu"))
+    await call.message.answer(text, reply_markup=kb)
     await state.set_state(BilimUlashAdminState.del_number)
     await call.answer()
 
+@dp.callback_query(BilimPage.filter())
+async def admin_numbers_nav(call: CallbackQuery, state: FSMContext, callback_data: BilimPage):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    if callback_data.dir == "next":
+        text, kb = render_bilim_page(after=callback_data.anchor)
+    else:
+        text, kb = render_bilim_page(before=callback_data.anchor)
+    await state.set_state(BilimUlashAdminState.del_number)
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass  # "message is not modified"
+    await call.answer()
+
+@dp.callback_query(F.data == "admin_numbers_jump")
+async def admin_numbers_jump(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    await state.set_state(BilimUlashAdminState.jump_number)
+    await call.message.answer("🔎 Qaysi raqamdan boshlab ko'rsatay?", reply_markup=back_kb("admin_numbers_delete"))
+    await call.answer()
+
+@dp.message(BilimUlashAdminState.jump_number, F.text)
+async def admin_numbers_jump_number(msg: Message, state: FSMContext):
+    await record_last_user_message(msg, state)
+    if msg.from_user.id != ADMIN_ID:
+        return
+    if not msg.text.isdigit():
+        await msg.answer("Raqamni to'g'ri kiriting (faqat son):", reply_markup=back_kb("admin_numbers_delete"))
+        return
+    text, kb = render_bilim_page(at=int(msg.text))
+    await msg.answer(text, reply_markup=kb)
+    await state.set_state(BilimUlashAdminState.del_number)
+
 @dp.message(BilimUlashAdminState.del_number, F.text)
 async def admin_numbers_delete_number(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
@@ -1058,7 +2925,7 @@ async def admin_numbers_delete_number(msg: Message, state: FSMContext):
         await msg.answer("Raqamni to'g'ri kiriting (faqat son):", reply_markup=back_kb("admin_numbers_menu"))
         return
     num = int(msg.text)
-    if delete_bilim_number(num):
+    if await db.delete_bilim_number(num):
         await msg.answer("? Raqam o'chirildi.", reply_markup=admin_numbers_kb())
         await state.clear()
     else:
@@ -1088,7 +2955,7 @@ async def admin_order_ready(call: CallbackQuery, state: FSMContext):
         await call.message.delete()
     except Exception:
         pass
-    await call.message.answer("📦 Faylni yuboring (video, foto, hujjat):", reply_markup=back_kb("admin_back_send"))
+    await call.message.answer("📦 Faylni yuboring (video, foto, hujjat):", reply_markup=order_ready_kb())
     await call.answer()
 
 @dp.callback_query(F.data == "admin_back_send")
@@ -1117,7 +2984,7 @@ async def admin_back_from_number(call: CallbackQuery, state: FSMContext):
         await call.message.delete()
     except Exception:
         pass
-    await call.message.answer("📦 Faylni yuboring (video, foto, hujjat):", reply_markup=back_kb("admin_back_send"))
+    await call.message.answer("📦 Faylni yuboring (video, foto, hujjat):", reply_markup=order_ready_kb())
     await call.answer()
 
 @dp.callback_query(F.data == "admin_back_comment")
@@ -1163,7 +3030,7 @@ async def admin_send_user_number(msg: Message, state: FSMContext):
         await msg.answer("Tartib raqamini to'g'ri kiriting (faqat son):", reply_markup=back_kb("admin_back_file"))
         return
     num = int(msg.text)
-    user_id = get_user_by_status(num)
+    user_id = await db.get_user_by_status(num)
     if user_id is None:
         await msg.answer("Bunday tartib raqamli user topilmadi. Qayta kiriting:", reply_markup=back_kb("admin_back_file"))
         return
@@ -1171,6 +3038,14 @@ async def admin_send_user_number(msg: Message, state: FSMContext):
     await msg.answer("✍️ Userga izoh yozing (masalan: Buyurtma sizga yoqdimi):", reply_markup=back_kb("admin_back_comment"))
     await state.set_state(AdminSendState.comment)
 
+async def send_ready_file(user_id: int, file_type: str, file_id: str, caption: str | None = None):
+    if file_type == "photo":
+        await bot.send_photo(user_id, file_id, caption=caption)
+    elif file_type == "video":
+        await bot.send_video(user_id, file_id, caption=caption)
+    else:
+        await bot.send_document(user_id, file_id, caption=caption)
+
 @dp.message(AdminSendState.comment, F.text)
 async def admin_send_comment(msg: Message, state: FSMContext):
     await record_last_user_message(msg, state)
@@ -1183,25 +3058,671 @@ async def admin_send_comment(msg: Message, state: FSMContext):
     caption = f"✅ Buyurtmangiz tayyor!\n\n💬 Izoh: {comment}"
 
     try:
-        if file_type == "photo":
-            await bot.send_photo(target_user_id, file_id, caption=caption)
-        elif file_type == "video":
-            await bot.send_video(target_user_id, file_id, caption=caption)
-        else:
-            await bot.send_document(target_user_id, file_id, caption=caption)
+        await send_ready_file(target_user_id, file_type, file_id, caption)
         await msg.answer("✅ Fayl userga yuborildi.", reply_markup=menu_kb(is_admin=True))
     except Exception as e:
         await msg.answer(f"❌ Xatolik: {e}", reply_markup=menu_kb(is_admin=True))
     await state.clear()
 
+# ===================== ADMIN: BUYURTMA TAYYOR (BATCH) =====================
+# Admin bir nechta fayl (yoki albom) yuboradi, so'ng tartib raqamlari ro'yxatini beradi:
+# raqamlar soni = fayllar soni — mos ravishda; bitta fayl — hamma raqamlarga; bitta raqam — hamma fayllar unga.
+BATCH_DELIVERY_CONCURRENCY = 10
+_batch_files_lock = asyncio.Lock()  # albom qismlari parallel keladi — ro'yxatga qo'shish ketma-ket
+
+@cache
+def batch_files_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Fayllar tayyor", callback_data="admin_send_batch_done")],
+        [InlineKeyboardButton(text="⬅️ Orqaga qaytish", callback_data="admin_back_send")],
+    ])
+
+def plan_batch_delivery(files: list[dict], numbers: list[int]) -> list[tuple[int, list[dict]]] | None:
+    if len(numbers) == len(files):
+        return [(n, [f]) for n, f in zip(numbers, files)]
+    if len(files) == 1:
+        return [(n, files) for n in numbers]
+    if len(numbers) == 1:
+        return [(numbers[0], files)]
+    return None
+
+@dp.callback_query(F.data == "admin_send_batch")
+async def admin_send_batch(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    await state.clear()
+    await state.set_state(AdminSendState.batch_files)
+    await state.update_data(batch_files=[])
+    try:
+        await call.message.delete()
+    except Exception:
+        pass
+    await call.message.answer(
+        "📚 Fayllarni yuboring (foto, video, hujjat yoki albom). Tugatgach «✅ Fayllar tayyor» ni bosing.",
+        reply_markup=batch_files_kb()
+    )
+    await call.answer()
+
+@dp.message(AdminSendState.batch_files, F.photo | F.video | F.document)
+async def admin_send_batch_file(msg: Message, state: FSMContext):
+    if msg.photo:
+        item = {"file_id": msg.photo[-1].file_id, "file_type": "photo"}
+    elif msg.video:
+        item = {"file_id": msg.video.file_id, "file_type": "video"}
+    else:
+        item = {"file_id": msg.document.file_id, "file_type": "document"}
+    async with _batch_files_lock:
+        data = await state.get_data()
+        files = (data.get("batch_files") or []) + [item]
+        first_of_group = msg.media_group_id is None or msg.media_group_id != data.get("batch_group")
+        await state.update_data(batch_files=files, batch_group=msg.media_group_id)
+    if first_of_group:
+        await msg.answer(f"➕ {len(files)}-fayl qabul qilindi. Davom eting yoki «✅ Fayllar tayyor» ni bosing.", reply_markup=batch_files_kb())
+
+@dp.callback_query(F.data == "admin_send_batch_done")
+async def admin_send_batch_done(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    files = (await state.get_data()).get("batch_files") or []
+    if not files:
+        await call.answer("Avval kamida bitta fayl yuboring.", show_alert=True)
+        return
+    await state.set_state(AdminSendState.batch_numbers)
+    await call.message.answer(
+        f"📋 {len(files)} ta fayl. Tartib raqamlarini yuboring (masalan: 12 15 18).\n"
+        "Har fayl uchun bittadan — tartib bilan; bitta fayl bo'lsa — hamma raqamlarga; bitta raqam — hamma fayllar unga.",
+        reply_markup=back_kb("admin_back_send")
+    )
+    await call.answer()
+
+@dp.message(AdminSendState.batch_numbers, F.text)
+async def admin_send_batch_numbers(msg: Message, state: FSMContext):
+    numbers = [int(n) for n in re.findall(r"\d+", msg.text)]
+    files = (await state.get_data()).get("batch_files") or []
+    plan = plan_batch_delivery(files, numbers) if numbers else None
+    if plan is None:
+        await msg.answer(
+            f"Raqamlar soni ({len(numbers)}) fayllar soniga ({len(files)}) mos emas. Qayta kiriting:",
+            reply_markup=back_kb("admin_back_send")
+        )
+        return
+    await state.update_data(batch_plan=[[n, fs] for n, fs in plan])
+    await state.set_state(AdminSendState.batch_comment)
+    await msg.answer("✍️ Userlarga izoh yozing (izohsiz bo'lsa «-»):", reply_markup=back_kb("admin_back_send"))
+
+@dp.message(AdminSendState.batch_comment, F.text)
+async def admin_send_batch_comment(msg: Message, state: FSMContext):
+    plan = (await state.get_data()).get("batch_plan") or []
+    await state.clear()
+    comment = msg.text.strip()
+    caption = "✅ Buyurtmangiz tayyor!" + (f"\n\n💬 Izoh: {comment}" if comment != "-" else "")
+    limit = asyncio.Semaphore(BATCH_DELIVERY_CONCURRENCY)
+
+    async def deliver(number: int, files: list[dict]) -> str | None:
+        async with limit:
+            user_id = await db.get_user_by_status(number)
+            if user_id is None:
+                return "topilmadi"
+            try:
+                for i, f in enumerate(files):
+                    await send_ready_file(user_id, f["file_type"], f["file_id"], caption if i == 0 else None)
+            except Exception as e:
+                return str(e)
+            return None
+
+    progress = await msg.answer(f"⏳ {len(plan)} ta userga yuborilmoqda...")
+    errors = await asyncio.gather(*(deliver(n, fs) for n, fs in plan))
+    ok = [n for (n, _), err in zip(plan, errors) if err is None]
+    failed = [(n, err) for (n, _), err in zip(plan, errors) if err is not None]
+    lines = [f"📦 Yetkazildi: {len(ok)}/{len(plan)}"]
+    if ok:
+        lines.append("✅ " + ", ".join(f"#{n}" for n in ok))
+    lines += [f"❌ #{n} — {err}" for n, err in failed]
+    text = "\n".join(lines)
+    if len(text) > 4000:
+        text = text[:4000] + "…"
+    try:
+        await progress.delete()
+    except Exception:
+        pass
+    await msg.answer(text, reply_markup=menu_kb(is_admin=True))
+
+# ===================== ADMIN: BUYURTMALAR =====================
+ORDERS_PAGE_SIZE = 8
+ORDER_KIND_LABELS = {"slide": "📝 Slayd", "video": "🎥 AI"}
+
+def order_summary(order: dict) -> str:
+    fields = order["fields"]
+    about = fields.get("topic") or fields.get("prompt") or ""
+    if len(about) > 40:
+        about = about[:40] + "…"
+    return f"#{order['id']} {ORDER_KIND_LABELS.get(order['kind'], order['kind'])} | {order['price']} so'm | {about}"
+
+async def render_orders_page(state: FSMContext, after_id: int = 0, before_id: int | None = None):
+    items, has_prev, has_next = await orders.page("pending", after_id, before_id, ORDERS_PAGE_SIZE)
+    total = await orders.count("pending")
+    data = await state.get_data()
+    selected = set(data.get("orders_selected") or [])
+    await state.update_data(orders_after=items[0]["id"] - 1 if items else 0)
+    if not items:
+        text = "🧾 Kutilayotgan buyurtmalar yo'q."
+    else:
+        text = f"🧾 Kutilayotgan buyurtmalar: {total}\n\n" + "\n".join(order_summary(o) for o in items)
+    rows = [
+        [InlineKeyboardButton(
+            text=("✅ " if o["id"] in selected else "☑️ ") + f"#{o['id']}",
+            callback_data=OrderSelect(order_id=o["id"]).pack(),
+        ) for o in items[i:i + 4]]
+        for i in range(0, len(items), 4)
+    ]
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=OrdersPage(dir="prev", anchor=items[0]["id"]).pack()))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=OrdersPage(dir="next", anchor=items[-1]["id"]).pack()))
+    if nav:
+        rows.append(nav)
+    if selected:
+        rows.append([
+            InlineKeyboardButton(text=f"➕ Tasdiqlash ({len(selected)})", callback_data="admin_orders_ok"),
+            InlineKeyboardButton(text=f"➖ Rad etish ({len(selected)})", callback_data="admin_orders_no"),
+        ])
+    rows.append([InlineKeyboardButton(text="⬅️ Orqaga qaytish", callback_data="admin_orders_back")])
+    return text, InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def show_orders_page(call: CallbackQuery, state: FSMContext, after_id: int = 0, before_id: int | None = None):
+    text, kb = await render_orders_page(state, after_id, before_id)
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass  # "message is not modified"
+
+@dp.callback_query(F.data == "admin_orders")
+async def admin_orders(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    await state.clear()
+    await show_orders_page(call, state)
+    await call.answer()
+
+@dp.callback_query(F.data == "admin_orders_back")
+async def admin_orders_back(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    await state.clear()  # tanlangan buyurtmalar ham unutiladi
+    try:
+        await call.message.edit_text("⚙️ Admin panel", reply_markup=admin_panel_kb())
+    except TelegramBadRequest:
+        await call.message.answer("⚙️ Admin panel", reply_markup=admin_panel_kb())
+    await call.answer()
+
+@dp.callback_query(OrdersPage.filter())
+async def admin_orders_nav(call: CallbackQuery, state: FSMContext, callback_data: OrdersPage):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    if callback_data.dir == "next":
+        await show_orders_page(call, state, after_id=callback_data.anchor)
+    else:
+        await show_orders_page(call, state, before_id=callback_data.anchor)
+    await call.answer()
+
+@dp.callback_query(OrderSelect.filter())
+async def admin_orders_select(call: CallbackQuery, state: FSMContext, callback_data: OrderSelect):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    order_id = callback_data.order_id
+    data = await state.get_data()
+    selected = set(data.get("orders_selected") or [])
+    selected ^= {order_id}
+    await state.update_data(orders_selected=sorted(selected))
+    await show_orders_page(call, state, after_id=data.get("orders_after", 0))
+    await call.answer()
+
+@dp.callback_query(F.data.in_({"admin_orders_ok", "admin_orders_no"}))
+async def admin_orders_batch(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    approved = call.data == "admin_orders_ok"
+    data = await state.get_data()
+    selected = data.get("orders_selected") or []
+    if not selected:
+        await call.answer("Hech narsa tanlanmagan.", show_alert=True)
+        return
+    changed = await orders.transition_many(selected, "approved" if approved else "declined")
+    # Userlarga xabar jobs orqali: yuborilmasa qayta uriniladi, holat esa allaqachon yozilgan
+    await jobs.enqueue_many("order_decision", [order_decision_job(o, approved) for o in changed])
+    await state.update_data(orders_selected=[])
+    await show_orders_page(call, state, after_id=data.get("orders_after", 0))
+    verb = "tasdiqlandi" if approved else "rad etildi"
+    report = f"{len(changed)} ta buyurtma {verb}."
+    if len(changed) < len(selected):
+        report += f" {len(selected) - len(changed)} tasi allaqachon ko'rib chiqilgan."
+    await call.answer(report, show_alert=True)
+
+# ===================== ADMIN: HAMMAGA XABAR (BROADCAST) =====================
+# Admin yuborgan xabar barcha ro'yxatdan o'tganlarga copy_message bilan tarqatiladi. User ro'yxati
+# BROADCAST_CHUNK ta id dan o'qiladi, har bo'lakdan keyin kursor DB_FILE ga yoziladi — bot qayta ishga
+# tushsa tarqatish o'sha joydan davom etadi. Tezlik chegarasi send_queue'da (PRIORITY_BULK).
+# Botni bloklaganlar blocked_users ga yoziladi va keyingi safar o'tkazib yuboriladi.
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))
+BROADCAST_CHUNK = 100
+BROADCAST_PROGRESS_INTERVAL = 3.0
+
+class Broadcaster:
+    def __init__(self, path: Path):
+        self.conn = open_sqlite(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id               INTEGER PRIMARY KEY AUTOINCREMENT,
+                from_chat_id     INTEGER NOT NULL,
+                message_id       INTEGER NOT NULL,
+                progress_chat_id INTEGER NOT NULL,
+                progress_msg_id  INTEGER NOT NULL,
+                cursor           INTEGER NOT NULL DEFAULT 0,
+                sent             INTEGER NOT NULL DEFAULT 0,
+                failed           INTEGER NOT NULL DEFAULT 0,
+                blocked          INTEGER NOT NULL DEFAULT 0,
+                status           TEXT NOT NULL DEFAULT 'running',
+                created          REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS blocked_users (
+                user_id    INTEGER PRIMARY KEY,
+                blocked_at REAL NOT NULL
+            );
+        """)
+        self.lock = threading.Lock()
+        self.blocked: set[int] = {r[0] for r in self.conn.execute("SELECT user_id FROM blocked_users")}
+        self.tasks: dict[int, asyncio.Task] = {}
+        self.stopping: set[int] = set()
+
+    def _execute(self, sql: str, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params)
+
+    def _create(self, from_chat_id: int, message_id: int, progress_chat_id: int, progress_msg_id: int) -> dict:
+        with self.lock:
+            bid = self.conn.execute(
+                "INSERT INTO broadcasts (from_chat_id, message_id, progress_chat_id, progress_msg_id, created)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (from_chat_id, message_id, progress_chat_id, progress_msg_id, time()),
+            ).lastrowid
+            return dict(self.conn.execute("SELECT * FROM broadcasts WHERE id = ?", (bid,)).fetchone())
+
+    def _running(self) -> list[dict]:
+        return [dict(r) for r in self._execute("SELECT * FROM broadcasts WHERE status = 'running'").fetchall()]
+
+    def _checkpoint(self, bc: dict, newly_blocked: list[int]):
+        now = time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO blocked_users (user_id, blocked_at) VALUES (?, ?)",
+                    [(uid, now) for uid in newly_blocked],
+                )
+                self.conn.execute(
+                    "UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, blocked = ?, status = ? WHERE id = ?",
+                    (bc["cursor"], bc["sent"], bc["failed"], bc["blocked"], bc["status"], bc["id"]),
+                )
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    @property
+    def active(self) -> bool:
+        return any(not t.done() for t in self.tasks.values())
+
+    async def start(self, from_chat_id: int, message_id: int, progress_chat_id: int, progress_msg_id: int) -> int:
+        bc = await run_storage(self._create, from_chat_id, message_id, progress_chat_id, progress_msg_id)
+        self.tasks[bc["id"]] = asyncio.create_task(self._run(bc))
+        return bc["id"]
+
+    async def resume(self):
+        """Qayta ishga tushganda tugallanmagan tarqatishlarni kursordan davom ettirish."""
+        for bc in await run_storage(self._running):
+            self.tasks[bc["id"]] = asyncio.create_task(self._run(bc))
+
+    def stop(self, bid: int) -> bool:
+        task = self.tasks.get(bid)
+        if task is None or task.done():
+            return False
+        self.stopping.add(bid)
+        return True
+
+    async def close(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+    async def unblock(self, user_id: int):
+        if user_id in self.blocked:
+            self.blocked.discard(user_id)
+            await run_storage(self._execute, "DELETE FROM blocked_users WHERE user_id = ?", (user_id,))
+
+    async def _deliver(self, bc: dict, user_id: int, limit: asyncio.Semaphore, newly_blocked: list[int]):
+        async with limit:
+            try:
+                await bot.copy_message(chat_id=user_id, from_chat_id=bc["from_chat_id"], message_id=bc["message_id"])
+            except TelegramForbiddenError:
+                bc["blocked"] += 1
+                self.blocked.add(user_id)
+                newly_blocked.append(user_id)
+            except Exception:
+                bc["failed"] += 1
+            else:
+                bc["sent"] += 1
+
+    async def _run(self, bc: dict):
+        _update_timing.set(None)  # /broadcast update'idan meros qolgan kontekst
+        limit = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        started, done_before = monotonic(), bc["sent"] + bc["failed"] + bc["blocked"]
+        shown = 0.0
+        try:
+            try:
+                with send_priority(PRIORITY_BULK):
+                    while bc["id"] not in self.stopping:
+                        ids = await db.user_ids_after(bc["cursor"], BROADCAST_CHUNK)
+                        if not ids:
+                            bc["status"] = "done"
+                            break
+                        newly_blocked: list[int] = []
+                        await asyncio.gather(*(
+                            self._deliver(bc, uid, limit, newly_blocked) for uid in ids if uid not in self.blocked
+                        ))
+                        bc["cursor"] = ids[-1]
+                        await run_storage(self._checkpoint, bc, newly_blocked)
+                        if monotonic() - shown >= BROADCAST_PROGRESS_INTERVAL:
+                            shown = monotonic()
+                            rate = (bc["sent"] + bc["failed"] + bc["blocked"] - done_before) / max(shown - started, 1e-6)
+                            await self._show_progress(bc, rate)
+                    else:
+                        bc["status"] = "cancelled"
+                await run_storage(self._checkpoint, bc, [])
+            except Exception:
+                # Aks holda yozuv "running" bo'lib qoladi va yangi tarqatish qayta ishga tushguncha bloklanadi
+                log.exception("Xabar #%s tarqatilishi to'xtadi", bc["id"])
+                bc["status"] = "failed"
+                try:
+                    await run_storage(self._checkpoint, bc, [])
+                except Exception:
+                    log.exception("Xabar #%s holatini yozib bo'lmadi", bc["id"])
+            rate = (bc["sent"] + bc["failed"] + bc["blocked"] - done_before) / max(monotonic() - started, 1e-6)
+            await self._show_progress(bc, rate)
+        finally:
+            self.stopping.discard(bc["id"])
+            self.tasks.pop(bc["id"], None)
+
+    async def _show_progress(self, bc: dict, rate: float):
+        title = {
+            "running": "⏳ Yuborilmoqda", "done": "✅ Yakunlandi", "cancelled": "⛔ To'xtatildi",
+            "failed": "⚠️ Xato tufayli to'xtadi",
+        }[bc["status"]]
+        text = (
+            f"📣 Xabar #{bc['id']} — {title}\n\n"
+            f"✅ Yuborildi: {bc['sent']}\n"
+            f"❌ Xato: {bc['failed']}\n"
+            f"🚫 Bloklagan: {bc['blocked']}\n"
+            f"⚡ Tezlik: {rate:.1f} xabar/s"
+        )
+        kb = broadcast_stop_kb(bc["id"]) if bc["status"] == "running" else None
+        try:
+            with send_priority(PRIORITY_ADMIN):
+                await bot.edit_message_text(
+                    text, chat_id=bc["progress_chat_id"], message_id=bc["progress_msg_id"], reply_markup=kb,
+                )
+        except TelegramBadRequest:
+            pass  # xabar o'chirilgan yoki o'zgarmagan
+        except Exception as e:
+            log.warning("Xabar #%s holatini ko'rsatib bo'lmadi: %r", bc["id"], e)
+
+    def stats(self) -> dict:
+        return {"active": sum(not t.done() for t in self.tasks.values()), "blocked_users": len(self.blocked)}
+
+broadcaster = Broadcaster(DB_FILE)
+
+@cache
+def broadcast_stop_kb(broadcast_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⛔ To'xtatish", callback_data=BroadcastStop(broadcast_id=broadcast_id).pack())],
+    ])
+
+@cache
+def broadcast_confirm_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Yuborish", callback_data="broadcast_confirm")],
+        [InlineKeyboardButton(text="⬅️ Orqaga qaytish", callback_data="admin_back_send")],
+    ])
+
+async def ask_broadcast_message(msg: Message, state: FSMContext):
+    if broadcaster.active:
+        await msg.answer("⏳ Oldingi xabar hali tarqatilmoqda. Tugashini kuting yoki to'xtating.")
+        return
+    await state.set_state(BroadcastState.message)
+    await msg.answer(
+        "📣 Barcha userlarga yuboriladigan xabarni yuboring (matn, foto, video, hujjat):",
+        reply_markup=back_kb("admin_back_send"),
+    )
+
+@dp.callback_query(F.data == "admin_broadcast")
+async def admin_broadcast(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    await state.clear()
+    try:
+        await call.message.delete()
+    except Exception:
+        pass
+    await ask_broadcast_message(call.message, state)
+    await call.answer()
+
+@dp.message(BroadcastState.message)
+async def admin_broadcast_message(msg: Message, state: FSMContext):
+    if msg.from_user.id != ADMIN_ID:
+        return
+    await state.update_data(broadcast_chat_id=msg.chat.id, broadcast_msg_id=msg.message_id)
+    await state.set_state(BroadcastState.confirm)
+    await msg.answer("Yuqoridagi xabar barcha userlarga yuborilsinmi?", reply_markup=broadcast_confirm_kb())
+
+@dp.callback_query(BroadcastState.confirm, F.data == "broadcast_confirm")
+async def admin_broadcast_confirm(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    if broadcaster.active:
+        await call.answer("Oldingi xabar hali tarqatilmoqda.", show_alert=True)
+        return
+    data = await state.get_data()
+    await state.clear()
+    await call.message.edit_text("📣 Tarqatish boshlanmoqda...")
+    bid = await broadcaster.start(
+        data["broadcast_chat_id"], data["broadcast_msg_id"], call.message.chat.id, call.message.message_id,
+    )
+    await call.answer(f"Xabar #{bid} tarqatilmoqda.")
+
+@dp.callback_query(BroadcastStop.filter())
+async def admin_broadcast_stop(call: CallbackQuery, callback_data: BroadcastStop):
+    if call.from_user.id != ADMIN_ID:
+        await call.answer()
+        return
+    if broadcaster.stop(callback_data.broadcast_id):
+        await call.answer("To'xtatilmoqda...")
+    else:
+        await call.answer("Bu xabar allaqachon tugagan.", show_alert=True)
+
+# ===================== MENYU MARSHRUTLARI =====================
+# Ustuvorlik avvalgi tartibni saqlaydi: /start, /admin, /broadcast va admin panel har doim birinchi;
+# Bilim/Slayd/AI Video faqat o'zidan oldin ro'yxatdan o'tgan oqimlarning matn kiritishiga yo'l beradi;
+# /ping va kontakt tugmalari har qanday holat handleridan keyin tekshiriladi.
+_REG_INPUT = frozenset(RegState.__all_states_names__)
+_BILIM_INPUT = _REG_INPUT | frozenset(BilimUlashUserState.__all_states_names__)
+_SLIDE_INPUT = _BILIM_INPUT | frozenset(SlideState.__all_states_names__)
+
+MENU_ROUTES: dict[str, MenuRoute] = {
+    "/start": MenuRoute(start),
+    "/admin": MenuRoute(admin_panel_first),
+    "/broadcast": MenuRoute(admin_broadcast_cmd),
+    "/ping": MenuRoute(debug_ping, yields_any=True),
+    "/slow": MenuRoute(debug_slow),
+    "/profile": MenuRoute(debug_profile, takes_args=True),
+}
+for _texts, _route in (
+    ((BTN_ADMIN, "Admin panel"), MenuRoute(admin_panel_first)),
+    ((BTN_BILIM, "Bilim Ulash"), MenuRoute(bilim_ulash_start, _REG_INPUT)),
+    ((BTN_SLIDE, "Slayd buyurtma"), MenuRoute(slide_start, _BILIM_INPUT)),
+    ((BTN_VIDEO, "AI Video"), MenuRoute(ai_video, _SLIDE_INPUT)),
+    ((BTN_CONTACT, "Admin bilan bog'lanish", "Admin bilan boglanish"), MenuRoute(admin_contact, yields_any=True)),
+    ((BTN_BOT, "Bot yaratib berish"), MenuRoute(bot_create_contact, yields_any=True)),
+):
+    MENU_ROUTES.update(dict.fromkeys(_texts, _route))
+
+@dp.message(MenuButton(front=False))
+async def menu_fallback(msg: Message, state: FSMContext, user_record: UserRecord, menu_route: MenuRoute):
+    await menu_route.handler(msg, state, user_record)
+
 # ===================== /start qayta bosilganda (ro'yxatdan o'tgan) =====================
 # SubState da qolgan user /start qayta bosganda - qayta obuna ko'rsatamiz
 # (yuqorida /start allaqachon bor)
 
+# ===================== WEBHOOK =====================
+# WEBHOOK_URL berilsa long polling o'rniga aiohttp server ishlaydi. Update'lar fonda qayta ishlanadi
+# (handle_in_background) — sekin handler HTTP javobni ushlab turmaydi.
+async def on_webhook_startup(bot: Bot):
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        drop_pending_updates=DROP_PENDING_UPDATES,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+async def on_webhook_shutdown(bot: Bot):
+    await bot.delete_webhook()
+
+async def run_webhook():
+    dp.startup.register(on_webhook_startup)
+    dp.shutdown.register(on_webhook_shutdown)
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, handle_in_background=True,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    log.info("Webhook: %s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+    # Polling'da aiogram SIGTERM/SIGINT ni o'zi ushlaydi; bu yerda ham main() dagi finally
+    # (FSM flush, jobs.stop, sessiyani yopish) ishlashi uchun signal to'xtash hodisasiga aylantiriladi.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    try:
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.remove_signal_handler(sig)
+            except NotImplementedError:
+                pass
+        await runner.cleanup()
+
+# ===================== METRICS (HTTP) =====================
+@metrics.sampled("bot_throttle_dropped_total", "Anti-flood tashlab yuborgan update'lar", kind="counter")
+def _throttle_dropped():
+    return throttle.dropped
+
+@metrics.sampled("bot_fsm_contexts", "Xotiradagi FSM kontekstlari")
+def _fsm_contexts():
+    if isinstance(fsm_storage, PersistentFSMStorage):
+        return fsm_storage.stats()["live"]
+    return len(fsm_storage.storage)
+
+@metrics.sampled("bot_fsm_evicted_total", "TTL bo'yicha o'chirilgan FSM kontekstlari", kind="counter")
+def _fsm_evicted():
+    if isinstance(fsm_storage, PersistentFSMStorage):
+        return fsm_storage.stats()["evicted"]
+    return {}
+
+@metrics.sampled("bot_users_cache_total", "users.json keshi", ("result",), kind="counter")
+def _users_cache_metrics():
+    return dict(_users_cache_counters)
+
+@metrics.sampled("bot_users_cache_hit_ratio", "users.json keshidan javob berilgan o'qishlar ulushi")
+def _users_cache_hit_ratio():
+    return users_cache_stats()["hit_rate"]
+
+@metrics.sampled("bot_send_queue_depth", "Yuborish navbatidagi so'rovlar", ("priority",))
+def _send_queue_depth():
+    names = {PRIORITY_USER: "user", PRIORITY_ADMIN: "admin", PRIORITY_BULK: "bulk"}
+    return {**{names[p]: n for p, n in send_queue.depth.items()}, "delayed": send_queue.delayed}
+
+@metrics.sampled("bot_send_queue_total", "Yuborish navbati natijalari", ("result",), kind="counter")
+def _send_queue_total():
+    return send_queue.counters
+
+@metrics.sampled("bot_jobs_total", "Fon ishlari natijalari", ("result",), kind="counter")
+def _jobs_total():
+    return jobs.counters
+
+@metrics.sampled("bot_jobs_queued", "Navbatdagi fon ishlari")
+def _jobs_queued():
+    return jobs.stats()["scheduled"]
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server() -> web.AppRunner | None:
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    log.info("Metrics: http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
 # ===================== RUN =====================
 async def main():
     print("Bot ishga tushdi...")
-    await dp.start_polling(bot)
+    compactor = sweeper = None
+    if isinstance(user_store, JournalUserStore):
+        compactor = asyncio.create_task(journal_compactor(user_store))
+    if isinstance(fsm_storage, PersistentFSMStorage):
+        sweeper = asyncio.create_task(fsm_sweeper(fsm_storage))
+    await jobs.start()
+    await broadcaster.resume()
+    metrics_runner = await start_metrics_server()
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+            await dp.start_polling(bot)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await broadcaster.close()
+        await jobs.stop()
+        if sweeper:
+            sweeper.cancel()
+        await fsm_storage.close()
+        if compactor:
+            compactor.cancel()
+            await compact_journal(user_store)
+        await bot.session.close()  # polling buni o'zi yopadi, webhook rejimida esa yopilmaydi
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     asyncio.run(main())
@@ -0,0 +1,48 @@
+import os
+import tempfile
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("FSM_STORAGE", "memory")
+os.environ.setdefault("DB_FILE", os.path.join(tempfile.mkdtemp(), "bot.sqlite3"))
+
+from main import BilimEntry, BilimIndex
+
+
+def make_index(count: int) -> BilimIndex:
+    return BilimIndex((n, BilimEntry(f"t{n}")) for n in range(1, count + 1))
+
+
+def numbers(page) -> list[int]:
+    return [n for n, _ in page[0]]
+
+
+def test_next_and_prev_do_not_overlap():
+    index = make_index(25)
+    first = index.page(limit=20)
+    assert numbers(first) == list(range(1, 21))
+    assert first[1:] == (False, True)
+
+    second = index.page(after=20, limit=20)
+    assert numbers(second) == list(range(21, 26))
+    assert second[1:] == (True, False)
+
+    back = index.page(before=21, limit=20)
+    assert numbers(back) == list(range(1, 21))
+    assert back[1:] == (False, True)
+
+
+def test_page_at_starts_at_number_and_clamps_past_end():
+    index = make_index(25)
+    assert numbers(index.page_at(3, limit=20)) == list(range(3, 23))
+    assert numbers(index.page_at(100, limit=20)) == list(range(6, 26))
+    assert numbers(BilimIndex().page_at(5)) == []
+
+
+def test_set_and_discard_keep_numbers_sorted():
+    index = make_index(3)
+    index.set(10, BilimEntry("x"))
+    index.set(0, BilimEntry("y"))
+    index.discard(2)
+    assert index.numbers == [0, 1, 3, 10]
+    assert numbers(index.page(after=1, limit=2)) == [3, 10]